@@ -1,7 +1,11 @@
+import datetime
 import os
 import sys
 import multiprocessing
+import multiprocessing.pool
 import signal
+import threading
+import time
 
 try:
     import urlparse
@@ -9,7 +13,7 @@ except (ImportError, ModuleNotFoundError):
     # Python3
     from urllib.parse import urlparse
 
-from yumsync import util, progress
+from yumsync import download, util, progress
 from yumsync.log import log
 from yumsync.metadata import __version__
 
@@ -43,28 +47,80 @@ def unpickle_method(func_name, obj, cls):
 
 copy_reg.pickle(types.MethodType, pickle_method, unpickle_method)
 
-def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True):
+METADATA_BACKENDS = ('thread', 'process')
+# concurrent downloads across all repositories, unless max_connections is set
+DOWNLOAD_CONNECTIONS = 16
+
+class NoDaemonProcess(multiprocessing.get_context().Process):
+    """ Pool process that is allowed to start processes of its own.
+
+    Pool workers are daemonic, and daemonic processes cannot have children.
+    The process metadata backend needs its own pool inside each worker.
+    """
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+class NoDaemonContext(type(multiprocessing.get_context())):
+    Process = NoDaemonProcess
+
+def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True,
+         metadata_backend='thread', max_connections=None, max_rate=None):
     """ Mirror repositories with configuration data from multiple sources.
 
     Handles all input validation and higher-level logic before passing control
-    on to threads for doing the actual syncing. One thread is created per
-    repository to alleviate the impact of slow mirrors on faster ones.
+    on to processes for doing the actual syncing. Each repository is planned
+    in the process pool, then the packages of every repository are downloaded
+    by one scheduler in this process, which shares its connections fairly
+    between mirrors so slow mirrors do not hold up faster ones. As soon as the
+    downloads of a repository are done, its metadata is built in a second
+    pool, so it never waits behind plans. Each repository stays locked from
+    its plan to the end of its metadata.
+    max_rate bounds the total download rate in bytes per second, shared
+    between repositories according to their weight.
     """
 
     if repos is None:
         repos = []
+    if metadata_backend not in METADATA_BACKENDS:
+        raise ValueError('metadata_backend must be one of {}'.format(', '.join(METADATA_BACKENDS)))
+    sync_kwds = {"workers": workers, "metadata_backend": metadata_backend}
+    governor = download.Governor(max_rate) if max_rate else None
 
     # Don't multiprocess when asked
     if multiprocess == False:
+        start = time.time()
+        errors = 0
+        slots = threading.BoundedSemaphore(max_connections) if max_connections else None
         for repo in repos:
-            repo.sync()
-        sys.exit(0)
+            repo.set_download_slots(slots)
+            repo.set_download_governor(governor)
+            if repo.sync(**sync_kwds) is False:
+                errors += 1
+        return (len(repos), errors, str(datetime.timedelta(seconds=int(time.time() - start))))
 
     prog = progress.Progress()  # callbacks talk to this object
     manager = multiprocessing.Manager()
     queue = manager.Queue()
-    pool = multiprocessing.Pool(processes=processes)
-    process_results = []
+    def make_pool():
+        if metadata_backend == 'process':
+            return multiprocessing.pool.Pool(processes=processes, context=NoDaemonContext())
+        return multiprocessing.Pool(processes=processes)
+    pool = make_pool()
+    finish_pool = make_pool()
+    # all downloads happen here, bounded by max_connections
+    scheduler = download.Scheduler(workers=max_connections or DOWNLOAD_CONNECTIONS,
+                                   governor=governor)
+    repos_by_id = {}
+    callbacks = {}
+    plans = {}      # repo id -> async result of repo.plan_sync()
+    downloads = {}  # repo id -> [plan, targets left, failed targets]
+    finishes = {}   # repo id -> async result of repo.finish_sync()
+    locks = {}      # repo id -> held repo.hold_lock() context
 
     def signal_handler(_signum, _frame):
         """ Inner method for terminating threads on signal events.
@@ -75,6 +131,7 @@ def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True
         """
         log('Caught exit signal - aborting')
         pool.terminate()
+        finish_pool.terminate()
         sys.exit(1) # safe to do exit() here because we are a worker
 
     # Catch user-cancelled or killed signals to terminate threads.
@@ -84,6 +141,23 @@ def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True
     def err_callback(exc):
         logging.exception("A process ended with error")
 
+    def apply_async(func, args=(), kwds=None, target_pool=pool):
+        if six.PY2:
+            return target_pool.apply_async(func, args, kwds or {})
+        return target_pool.apply_async(func, args, kwds or {}, error_callback=err_callback)
+
+    def finish(repo_id, plan, failed):
+        finishes[repo_id] = apply_async(repos_by_id[repo_id].finish_sync, (plan, failed),
+                                        target_pool=finish_pool)
+
+    def release(repo_id):
+        locks.pop(repo_id).__exit__(None, None, None)
+
+    # lock in a fixed order, so concurrent runs cannot deadlock
+    for repo in sorted(repos, key=lambda r: r.id):
+        locks[repo.id] = repo.hold_lock()
+        locks[repo.id].__enter__()
+
     for repo in repos:
         logging.debug("Setup callback and async job for repo {}".format(repo.id))
         prog.update(repo.id) # Add the repo to the progress object
@@ -93,12 +167,11 @@ def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True
         repo.set_yum_callback(yumcallback)
         repo.set_repo_callback(repocallback)
 
-        if six.PY2:
-            process_results.append(pool.apply_async(repo.sync, kwds={"workers": workers}))
-        elif six.PY3:
-            process_results.append(pool.apply_async(repo.sync, kwds={"workers": workers}, error_callback=err_callback))
+        repos_by_id[repo.id] = repo
+        callbacks[repo.id] = repocallback
+        plans[repo.id] = apply_async(repo.plan_sync, kwds=sync_kwds)
 
-    while len(process_results) > 0:
+    while plans or downloads or finishes:
         # If data is waiting in the queue from the workers, process it. This
         # needs to be done in the current scope so that one progress object may
         # hold all of the results. (This might be easier with Python 3's
@@ -110,30 +183,69 @@ def sync(repos=None, callback=None, processes=None, workers=1, multiprocess=True
                 continue
             if event['action'] == 'repo_init' and 'data' in event:
                 prog.update(event['repo_id'], set_total=event['data'][0])
-            elif event['action'] == 'download_end' and 'data' in event:
-                prog.update(event['repo_id'], pkgs_downloaded=event['data'][0])
+            elif event['action'] == 'download_end':
+                prog.update(event['repo_id'], pkgs_downloaded=1)
             elif event['action'] == 'repo_metadata' and 'data' in event:
                 prog.update(event['repo_id'], repo_metadata=event['data'][0])
             elif event['action'] == 'repo_error' and 'data' in event:
                 prog.update(event['repo_id'], repo_error=event['data'][0])
             elif event['action'] == 'pkg_exists':
                 prog.update(event['repo_id'], pkgs_downloaded=1)
+            elif event['action'] == 'pkgs_exist' and 'data' in event:
+                prog.update(event['repo_id'], pkgs_downloaded=len(event['data'][0]))
             elif event['action'] == 'link_local_pkg':
                 prog.update(event['repo_id'], pkgs_downloaded=1)
+            elif event['action'] == 'repo_unchanged':
+                prog.update(event['repo_id'], repo_metadata='unchanged')
             elif event['action'] == 'repo_complete':
                 pass # should already know this, but handle it anyways.
             elif event['action'] == 'delete_pkg':
                 pass
             elif event['action'] == 'repo_group_data':
                 pass
-        for proc in process_results:
+        # Hand the packages of planned repositories to the scheduler
+        for repo_id, proc in list(plans.items()):
+            if not proc.ready():
+                continue
+            del plans[repo_id]
+            plan = proc.get() if proc.successful() else None
+            if plan is None:
+                logging.info("{}: nothing left to do after planning".format(repo_id))
+                release(repo_id)
+            elif plan['targets']:
+                repo = repos_by_id[repo_id]
+                downloads[repo_id] = [plan, len(plan['targets']), []]
+                scheduler.add(repo_id, plan['targets'], limit=repo.download_workers,
+                              host_connections=repo.host_connections, weight=repo.weight)
+            else:
+                finish(repo_id, plan, [])
+        # Build metadata of repositories whose downloads are all done
+        for repo_id, target, error in scheduler.completed():
+            pending = downloads[repo_id]
+            pending[1] -= 1
+            if error is None:
+                callbacks[repo_id].download_end(repo_id, target.name, target.size)
+            else:
+                pending[2].append(target)
+            if pending[1] == 0:
+                del downloads[repo_id]
+                finish(repo_id, pending[0], pending[2])
+        for repo_id, proc in list(finishes.items()):
             if proc.ready():
                 if proc.successful():
                     logging.info("A Process ended, removing from waiting list")
                 else:
                     logging.info("A Process ended with error, removing from waiting list")
-                process_results.remove(proc)
-
+                del finishes[repo_id]
+                release(repo_id)
+        time.sleep(0.1)
+
+    scheduler.close()
+    pool.close()
+    finish_pool.close()
+    pool.join()
+    finish_pool.join()
+    manager.shutdown()
 
     # Return tuple (#repos, #fail, elapsed time)
     return (len(repos), prog.totals['errors'], prog.elapsed())
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import sqlite3
+
+from yumsync import util
+
+class StatCache(object):
+    """ Persistent mapping of file paths to data, validated by file stats.
+
+    Entries are keyed by path and are only handed back while the size, mtime
+    and inode of the file still match the ones recorded when the entry was
+    stored. Paths which are neither looked up nor stored during a run are
+    dropped by prune(), so the cache follows the contents of the repository.
+    """
+    table = 'entries'
+
+    def __init__(self, path):
+        self.path = path
+        self._seen = set()
+        util.make_dir(os.path.dirname(path))
+        try:
+            self._db = self._connect()
+        except sqlite3.DatabaseError:
+            logging.warning('{}: unreadable cache, starting from scratch'.format(path))
+            os.unlink(path)
+            self._db = self._connect()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE IF NOT EXISTS {} (path TEXT PRIMARY KEY, size INTEGER, '
+                   'mtime REAL, inode INTEGER, data TEXT)'.format(self.table))
+        return db
+
+    def get(self, path, st):
+        """ Return the data stored for path if st still matches, else None. """
+        self._seen.add(path)
+        row = self._db.execute('SELECT size, mtime, inode, data FROM {} WHERE path = ?'.format(self.table),
+                               (path,)).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+            return None
+        return json.loads(row[3])
+
+    def put(self, path, st, data):
+        """ Store data for path along with the stats it is valid for. """
+        self._seen.add(path)
+        self._db.execute('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)'.format(self.table),
+                         (path, st.st_size, st.st_mtime, st.st_ino, json.dumps(data)))
+
+    def prune(self):
+        """ Drop every entry that was not used since the cache was opened. """
+        stale = [row[0] for row in self._db.execute('SELECT path FROM {}'.format(self.table))
+                 if row[0] not in self._seen]
+        self._db.executemany('DELETE FROM {} WHERE path = ?'.format(self.table), [(p,) for p in stale])
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+class PackageCache(StatCache):
+    """ Parsed package records, used to skip unchanged RPMs in build_metadata. """
+    table = 'packages'
+
+class VerificationLedger(StatCache):
+    """ Checksums of packages verified on disk, used to trust existing files. """
+    table = 'verified'
+
+class HeaderIndex(StatCache):
+    """ Validity and NEVRA of RPM headers, used to skip reading unchanged RPMs. """
+    table = 'headers'
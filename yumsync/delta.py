@@ -0,0 +1,97 @@
+""" Delta RPM support for remote repositories.
+
+When the upstream repository publishes prestodelta metadata and an older
+version of a package is still on disk, in the packages directory or in a
+snapshot, only the delta is downloaded and the new package is rebuilt from
+the old one with applydeltarpm.
+"""
+import binascii
+import collections
+import os
+import subprocess
+
+import hawkey
+
+from yumsync import headers
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+APPLYDELTARPM = 'applydeltarpm'
+# deltas larger than this fraction of the package are not worth rebuilding
+MAX_RATIO = 0.75
+
+def available():
+    return which(APPLYDELTARPM) is not None
+
+class DeltaError(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+class DeltaRpm(object):
+    """ A delta from the local package base to a package to download.
+
+    The delta is available at location on the mirrors of the package (or at
+    baseurl) and is downloaded to path before being applied.
+    """
+    def __init__(self, location, baseurl, size, checksum_type, checksum, base, path):
+        self.location = location
+        self.baseurl = baseurl
+        self.size = size
+        self.checksum_type = checksum_type
+        self.checksum = checksum
+        self.base = base
+        self.path = path
+
+    def rebuild(self, dest):
+        """ Apply the downloaded delta to the base package, writing dest. """
+        try:
+            subprocess.check_output([APPLYDELTARPM, '-r', self.base, self.path, dest],
+                                    stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise DeltaError('{} failed: {}'.format(APPLYDELTARPM, e.output.decode('utf-8', 'replace').strip()))
+
+class LocalPackages(object):
+    """ Packages already on disk, by name and arch, to rebuild deltas from. """
+    def __init__(self, dirs):
+        self._packages = collections.defaultdict(list)
+        for directory in dirs:
+            for filename in os.listdir(directory):
+                if not filename.endswith('.rpm'):
+                    continue
+                try:
+                    nevra = hawkey.split_nevra(filename[:-len('.rpm')])
+                except hawkey.ValueException:
+                    continue
+                self._packages[(nevra.name, nevra.arch)].append(os.path.join(directory, filename))
+
+    @staticmethod
+    def _evr(path):
+        """ Return the evr of a package the way hawkey formats it. """
+        nevra = headers.read_nevra(path)
+        if nevra is None:
+            return None
+        if nevra['epoch']:
+            return '{}:{}-{}'.format(nevra['epoch'], nevra['version'], nevra['release'])
+        return '{}-{}'.format(nevra['version'], nevra['release'])
+
+    def find_delta(self, po, path):
+        """ Return a DeltaRpm building po from a local package, or None. """
+        tried = set()
+        for base in self._packages.get((po.name, po.arch), ()):
+            if os.path.basename(base) == os.path.basename(po.localPkg()):
+                continue
+            evr = self._evr(base)
+            if evr is None or evr in tried:
+                continue
+            tried.add(evr)
+            delta = po.get_delta_from_evr(evr)
+            if delta is None or delta.downloadsize >= po.downloadsize * MAX_RATIO:
+                continue
+            checksum_type, checksum = delta.chksum
+            return DeltaRpm(delta.location, delta.baseurl, delta.downloadsize,
+                            hawkey.chksum_name(checksum_type),
+                            binascii.hexlify(checksum).decode('ascii'), base, path)
+        return None
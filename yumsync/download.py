@@ -0,0 +1,548 @@
+""" Parallel package downloads for remote repositories.
+
+dnf is only used to load the upstream metadata and select packages, the
+packages themselves are fetched here so concurrency can be tuned per repo,
+per host and across every sync process.
+"""
+import base64
+import collections
+import hashlib
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from six.moves import http_client
+from six.moves.urllib.parse import urljoin, urlparse
+from six.moves.urllib.request import Request, getproxies, proxy_bypass, urlopen
+
+from yumsync import util
+
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+TIMEOUT = 30
+# a transfer slower than STALL_RATE bytes/s over STALL_WINDOW seconds is
+# abandoned when other mirrors are left to try, unless the governor slowed it
+STALL_RATE = 16 * 1024
+STALL_WINDOW = 30
+# read size when a governor limits the rate, for smoother throttling
+GOVERNED_CHUNK_SIZE = 64 * 1024
+# seconds of transfer a governed repository may burst after being idle
+BURST = 0.5
+
+class DownloadError(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+def _basic_auth(username, password):
+    credentials = '{}:{}'.format(username, password or '').encode('utf-8')
+    return 'Basic {}'.format(base64.b64encode(credentials).decode('ascii'))
+
+class TransferSettings(object):
+    """ TLS, proxy and credential settings of a repository.
+
+    They are read from the dnf configuration of the repository, so packages
+    are fetched the way dnf itself would fetch them. Without a configured
+    proxy, the proxies of the environment are used.
+    """
+    def __init__(self, sslverify=True, sslcacert=None, sslclientcert=None, sslclientkey=None,
+                 proxy=None, proxy_username=None, proxy_password=None, username=None, password=None):
+        self.sslverify = sslverify
+        self.sslcacert = sslcacert
+        self.sslclientcert = sslclientcert
+        self.sslclientkey = sslclientkey
+        self.proxy = proxy
+        self.proxy_username = proxy_username
+        self.proxy_password = proxy_password
+        self.username = username
+        self.password = password
+
+    @classmethod
+    def from_repo(cls, repo):
+        """ Read the settings of a dnf repo, unset options being empty strings there. """
+        def option(name):
+            return getattr(repo, name, None) or None
+        return cls(sslverify=bool(getattr(repo, 'sslverify', True)),
+                   sslcacert=option('sslcacert'),
+                   sslclientcert=option('sslclientcert'),
+                   sslclientkey=option('sslclientkey'),
+                   proxy=option('proxy'),
+                   proxy_username=option('proxy_username'),
+                   proxy_password=option('proxy_password'),
+                   username=option('username'),
+                   password=option('password'))
+
+    def key(self):
+        return (self.sslverify, self.sslcacert, self.sslclientcert, self.sslclientkey,
+                self.proxy, self.proxy_username, self.proxy_password)
+
+    def ssl_context(self):
+        context = ssl.create_default_context(cafile=self.sslcacert)
+        if not self.sslverify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if self.sslclientcert:
+            context.load_cert_chain(self.sslclientcert, self.sslclientkey)
+        return context
+
+    def proxy_for(self, parsed):
+        """ Return the parsed proxy to reach a parsed URL through, or None. """
+        if self.proxy == '_none_':
+            return None
+        proxy = self.proxy
+        if not proxy:
+            proxy = getproxies().get(parsed.scheme)
+            if not proxy or proxy_bypass(parsed.hostname or ''):
+                return None
+        return urlparse(proxy if '://' in proxy else 'http://' + proxy)
+
+    def proxy_headers(self, proxy):
+        username = self.proxy_username or proxy.username
+        if not username:
+            return {}
+        return {'Proxy-Authorization': _basic_auth(username, self.proxy_password or proxy.password)}
+
+    def auth_headers(self, parsed):
+        username = self.username or parsed.username
+        if not username:
+            return {}
+        return {'Authorization': _basic_auth(username, self.password or parsed.password)}
+
+class DownloadTarget(object):
+    """ A package to fetch into a repository.
+
+    The package is available at location (relative to the repository root)
+    on each of the mirrors, and is written to dest once its size and
+    checksum have been verified. Until then it is kept at partial, which
+    later attempts or runs resume with a Range request. When delta is set,
+    the package is first rebuilt from a delta RPM (see yumsync.delta).
+    settings are the TransferSettings of its repository.
+    """
+    def __init__(self, name, location, mirrors, dest, size=None, checksum_type=None, checksum=None,
+                 partial=None, settings=None):
+        self.name = name
+        self.location = location
+        self.mirrors = mirrors
+        self.dest = dest
+        self.size = size
+        self.checksum_type = checksum_type
+        self.checksum = checksum
+        self.partial = partial or dest + '.part'
+        # (mirror, bytes, seconds, ok) of every attempt, for mirror scoring
+        self.samples = []
+        self.delta = None
+        self.settings = settings
+
+    def urls(self):
+        return ['{}/{}'.format(mirror.rstrip('/'), self.location.lstrip('/')) for mirror in self.mirrors]
+
+    def verify(self, path, digest=None):
+        """ Raise DownloadError unless path holds this exact package. """
+        size = os.path.getsize(path)
+        if self.size and size != self.size:
+            raise DownloadError('{}: size {} does not match expected {}'.format(self.name, size, self.size))
+        if self.checksum:
+            if digest is None:
+                digest = util.file_checksum(path, self.checksum_type)
+            if digest != self.checksum:
+                raise DownloadError('{}: {} checksum mismatch'.format(self.name, self.checksum_type))
+
+class Downloader(object):
+    """ Fetch packages over a pool of threads.
+
+    HTTP connections are kept alive and reused per thread and host, until
+    close(). The number of simultaneous connections is bounded per host, and
+    optionally by a semaphore shared with the downloaders of other
+    repositories. A governor limits the rate, transfers being accounted to
+    key (the repository). settings apply to targets without settings of
+    their own.
+    """
+    def __init__(self, workers=4, host_connections=None, slots=None, governor=None, key=None, settings=None):
+        self.workers = workers
+        self.host_connections = host_connections or workers
+        self.slots = slots
+        self.governor = governor
+        self.key = key
+        self.settings = settings or TransferSettings()
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._ssl_contexts = {}
+
+    def download(self, targets, callback=None):
+        """ Download every target, in parallel.
+
+        callback(target, error) is called from the calling thread as each
+        target finishes, error being None on success. Returns the targets
+        that could not be downloaded from any mirror.
+        """
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = dict((executor.submit(self.fetch, target), target) for target in targets)
+                for future in as_completed(futures):
+                    target = futures[future]
+                    error = future.exception()
+                    if error is not None:
+                        logging.warning('{}: {}'.format(target.name, error))
+                        failed.append(target)
+                    if callback:
+                        callback(target, error)
+        finally:
+            self.close()
+        return failed
+
+    def close(self):
+        """ Close the kept-alive connections of every thread. """
+        with self._hosts_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+    def fetch(self, target, key=None):
+        """ Download one target, trying each of its mirrors in turn.
+
+        A stalled transfer moves on to the next mirror, which resumes from the
+        bytes already received.
+        """
+        key = self.key if key is None else key
+        if target.delta is not None:
+            try:
+                self._fetch_delta(target, key)
+                return
+            except Exception as e:
+                logging.info('{}: delta not applied ({}), downloading the full package'.format(target.name, e))
+        errors = []
+        urls = target.urls()
+        for idx, (mirror, url) in enumerate(zip(target.mirrors, urls)):
+            start = time.time()
+            try:
+                nbytes = self._fetch_url(url, target, key, failover=idx < len(urls) - 1)
+            except (DownloadError, IOError, OSError, http_client.HTTPException) as e:
+                target.samples.append((mirror, 0, time.time() - start, False))
+                errors.append('{} ({})'.format(url, e))
+            else:
+                target.samples.append((mirror, nbytes, time.time() - start, True))
+                return
+        raise DownloadError('unable to download {}: {}'.format(target.name, '; '.join(errors) or 'no mirrors'))
+
+    def _fetch_url(self, url, target, key=None, failover=False):
+        """ Download target from url, returning the number of bytes received. """
+        part = target.partial
+        util.make_dir(os.path.dirname(part))
+        util.make_dir(os.path.dirname(target.dest))
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if target.size and offset == target.size:
+            # complete, but interrupted before being moved into place
+            try:
+                target.verify(part)
+            except DownloadError:
+                offset = 0
+            else:
+                os.rename(part, target.dest)
+                return 0
+        elif target.size and offset > target.size:
+            offset = 0
+        with self._connection_slot(url):
+            response = self.open(url, {'Range': 'bytes={:d}-'.format(offset)} if offset else None,
+                                 settings=target.settings)
+            if offset and getattr(response, 'status', None) != 206:
+                # the server ignored the range, start over
+                offset = 0
+            digest = hashlib.new(target.checksum_type) if target.checksum else None
+            if digest and offset:
+                with open(part, 'rb') as f:
+                    for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        digest.update(block)
+            received = 0
+            window_start, window_bytes, throttled = time.time(), 0, False
+            chunk_size = GOVERNED_CHUNK_SIZE if self.governor else CHUNK_SIZE
+            # return whatever arrived instead of blocking for a full chunk
+            read = getattr(response, 'read1', response.read)
+            try:
+                with open(part, 'ab' if offset else 'wb') as f, self._transfer(key):
+                    while True:
+                        chunk = read(chunk_size)
+                        if not chunk:
+                            break
+                        if self.governor and self.governor.throttle(key, len(chunk)):
+                            throttled = True
+                        f.write(chunk)
+                        if digest:
+                            digest.update(chunk)
+                        received += len(chunk)
+                        window_bytes += len(chunk)
+                        elapsed = time.time() - window_start
+                        if elapsed >= STALL_WINDOW:
+                            if failover and not throttled and window_bytes / elapsed < STALL_RATE:
+                                raise DownloadError('transfer stalled')
+                            window_start, window_bytes, throttled = time.time(), 0, False
+            finally:
+                response.close()
+        try:
+            target.verify(part, digest.hexdigest() if digest else None)
+        except DownloadError:
+            os.unlink(part)
+            raise
+        os.rename(part, target.dest)
+        return received
+
+    def _fetch_delta(self, target, key=None):
+        """ Download the delta of target and rebuild the package from it. """
+        delta = target.delta
+        drpm = DownloadTarget('{} (delta)'.format(target.name), delta.location,
+                              [delta.baseurl] if delta.baseurl else target.mirrors, delta.path,
+                              size=delta.size, checksum_type=delta.checksum_type, checksum=delta.checksum,
+                              settings=target.settings)
+        try:
+            self.fetch(drpm, key)
+        finally:
+            target.samples.extend(drpm.samples)
+        rebuilt = '{}.rpm'.format(delta.path)
+        try:
+            delta.rebuild(rebuilt)
+            target.verify(rebuilt)
+            os.rename(rebuilt, target.dest)
+        finally:
+            if os.path.lexists(delta.path):
+                os.unlink(delta.path)
+            if os.path.exists(rebuilt):
+                os.unlink(rebuilt)
+
+    @contextmanager
+    def _connection_slot(self, url):
+        host = urlparse(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.host_connections)
+            host_slot = self._hosts[host]
+        with host_slot:
+            if self.slots is None:
+                yield
+            else:
+                self.slots.acquire()
+                try:
+                    yield
+                finally:
+                    self.slots.release()
+
+    @contextmanager
+    def _transfer(self, key):
+        if self.governor is None:
+            yield
+        else:
+            with self.governor.transfer(key):
+                yield
+
+    def _ssl_context(self, settings):
+        with self._hosts_lock:
+            if settings.key() not in self._ssl_contexts:
+                self._ssl_contexts[settings.key()] = settings.ssl_context()
+            return self._ssl_contexts[settings.key()]
+
+    def _connection(self, parsed, settings, proxy, fresh=False):
+        """ Return this thread's keep-alive connection to a host. """
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        key = (parsed.scheme, parsed.hostname, parsed.port, settings.key())
+        if fresh and key in self._local.connections:
+            self._local.connections.pop(key).close()
+        if key not in self._local.connections:
+            host, port = parsed.hostname, parsed.port
+            if proxy is not None:
+                host, port = proxy.hostname, proxy.port or 8080
+            if parsed.scheme == 'https':
+                conn = http_client.HTTPSConnection(host, port, timeout=TIMEOUT, context=self._ssl_context(settings))
+                if proxy is not None:
+                    conn.set_tunnel(parsed.hostname, parsed.port, settings.proxy_headers(proxy))
+            else:
+                conn = http_client.HTTPConnection(host, port, timeout=TIMEOUT)
+            self._local.connections[key] = conn
+            with self._hosts_lock:
+                self._connections.append(conn)
+        return self._local.connections[key]
+
+    def open(self, url, headers=None, redirects=MAX_REDIRECTS, settings=None):
+        """ Send a GET request and return the response, following redirects. """
+        settings = settings or self.settings
+        headers = dict(headers or {})
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            return urlopen(Request(url, headers=headers), timeout=TIMEOUT)
+        headers.update(settings.auth_headers(parsed))
+        proxy = settings.proxy_for(parsed)
+        if proxy is not None and parsed.scheme == 'http':
+            # plain HTTP proxies take the whole URL
+            path = url
+            headers.update(settings.proxy_headers(proxy))
+        else:
+            path = parsed.path or '/'
+            if parsed.query:
+                path = '{}?{}'.format(path, parsed.query)
+        try:
+            conn = self._connection(parsed, settings, proxy)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (http_client.HTTPException, socket.error):
+            # the server may have closed an idle keep-alive connection
+            conn = self._connection(parsed, settings, proxy, fresh=True)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = response.getheader('Location')
+            response.read()
+            return self.open(urljoin(url, location), headers, redirects - 1, settings)
+        if response.status not in (200, 206):
+            response.read()
+            raise DownloadError('HTTP {} {}'.format(response.status, response.reason))
+        return response
+
+class Scheduler(object):
+    """ Download the packages of many repositories through one engine.
+
+    Targets are queued per repository and mirror host. Idle workers take the
+    next target in round robin across those queues, skipping hosts and
+    repositories that already use all of their connections. A slow mirror
+    then only holds its own share of the workers, while the others keep
+    serving the remaining repositories.
+    """
+    def __init__(self, workers=8, host_connections=None, slots=None, governor=None):
+        # host connections are bounded here, per repository
+        self.downloader = Downloader(workers, workers, slots, governor)
+        self.governor = governor
+        self.host_connections = host_connections or workers
+        self._queues = collections.OrderedDict()
+        self._limits = {}
+        self._host_limits = {}
+        self._active_hosts = collections.Counter()
+        self._active_keys = collections.Counter()
+        self._cond = threading.Condition()
+        self._completed = collections.deque()
+        self._closed = False
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def add(self, key, targets, limit=None, host_connections=None, weight=1):
+        """ Queue the targets of a repository, identified by key.
+
+        limit bounds the parallel downloads of this repository, and
+        host_connections its connections to a single host. weight is its
+        share of the bandwidth when a governor limits the rate.
+        """
+        if self.governor:
+            self.governor.set_weight(key, weight)
+        with self._cond:
+            self._limits[key] = limit
+            self._host_limits[key] = host_connections or self.host_connections
+            for target in targets:
+                host = urlparse(target.urls()[0]).netloc if target.mirrors else None
+                self._queues.setdefault((host, key), collections.deque()).append(target)
+            self._cond.notify_all()
+
+    def completed(self):
+        """ Return the (key, target, error) of targets finished since last call. """
+        done = []
+        while self._completed:
+            done.append(self._completed.popleft())
+        return done
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.downloader.close()
+
+    def _next(self):
+        """ Wait for a target this worker may start, in round robin. """
+        with self._cond:
+            while not self._closed:
+                for queue_key in list(self._queues):
+                    host, key = queue_key
+                    if self._limits[key] and self._active_keys[key] >= self._limits[key]:
+                        continue
+                    if host and self._active_hosts[host] >= self._host_limits[key]:
+                        continue
+                    queue = self._queues.pop(queue_key)
+                    target = queue.popleft()
+                    if queue:
+                        # back of the line until every other queue had a turn
+                        self._queues[queue_key] = queue
+                    self._active_hosts[host] += 1
+                    self._active_keys[key] += 1
+                    return host, key, target
+                self._cond.wait()
+        return None
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            host, key, target = item
+            try:
+                self.downloader.fetch(target, key)
+                error = None
+            except Exception as e:
+                logging.warning('{}: {}'.format(target.name, e))
+                error = e
+            with self._cond:
+                self._active_hosts[host] -= 1
+                self._active_keys[key] -= 1
+                self._completed.append((key, target, error))
+                self._cond.notify_all()
+
+class Governor(object):
+    """ Limit the total download rate, shared between repositories by weight.
+
+    Each repository with a transfer in progress gets rate * weight / total
+    weight of the active repositories, enforced with a token bucket of its
+    own allowing at most BURST seconds of burst.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._weights = {}
+        self._active = collections.Counter()
+        self._buckets = {}
+
+    def set_weight(self, key, weight):
+        with self._lock:
+            self._weights[key] = weight
+
+    @contextmanager
+    def transfer(self, key):
+        """ Mark key as active for the duration of a transfer. """
+        with self._lock:
+            self._active[key] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[key] -= 1
+
+    def throttle(self, key, nbytes):
+        """ Account nbytes to key, sleeping as needed to honour its rate.
+        Returns the seconds slept.
+        """
+        with self._lock:
+            now = time.time()
+            active_weight = sum(self._weights.get(k, 1) for k, n in self._active.items() if n > 0)
+            rate = self.rate * self._weights.get(key, 1) / float(max(active_weight, self._weights.get(key, 1)))
+            tokens, last = self._buckets.get(key, (0, now))
+            tokens = min(tokens + (now - last) * rate, rate * BURST) - nbytes
+            self._buckets[key] = (tokens, now)
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+            return -tokens / rate
+        return 0
@@ -0,0 +1,135 @@
+""" Compact binary manifests of snapshots, and diffs between them.
+
+A manifest lists the packages of a snapshot sorted by path, each with its
+NEVRA, size and checksum. Paths are front coded against the previous one
+and checksums stored as raw digests, so a manifest is a fraction of the
+size of the text metadata. As manifests are sorted, two of them are
+compared with a merge over both streams, without loading either.
+
+Snapshots built before manifests existed are read from their filelist,
+with paths only.
+"""
+import binascii
+import collections
+import os
+import struct
+import tempfile
+
+MANIFEST = 'manifest'
+FILELIST = 'filelist'
+MAGIC = b'YSMF\x01'
+# shared path prefix, path suffix, nevra, checksum type and digest lengths, size
+RECORD = struct.Struct('>HHHBBQ')
+READ_SIZE = 64 * 1024
+
+Entry = collections.namedtuple('Entry', ('path', 'nevra', 'size', 'checksum_type', 'checksum'))
+
+def nevra_string(name, epoch, version, release, arch):
+    """ Format a NEVRA the way rpm does, leaving out a zero epoch. """
+    if epoch and str(epoch) != '0':
+        return '{}-{}:{}-{}.{}'.format(name, epoch, version, release, arch)
+    return '{}-{}-{}.{}'.format(name, version, release, arch)
+
+def _common_prefix(a, b):
+    size = min(len(a), len(b), 0xffff)
+    idx = 0
+    while idx < size and a[idx] == b[idx]:
+        idx += 1
+    return idx
+
+def write(path, entries):
+    """ Atomically write the manifest of entries at path. """
+    # utf-8 preserves the order of code points, so this is also the byte order
+    records = sorted((e.path.encode('utf-8'), e) for e in entries)
+    fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(MAGIC)
+        previous = b''
+        for path_bytes, entry in records:
+            shared = _common_prefix(previous, path_bytes)
+            suffix = path_bytes[shared:]
+            nevra = (entry.nevra or '').encode('utf-8')
+            checksum_type = (entry.checksum_type or '').encode('ascii')
+            digest = binascii.unhexlify(entry.checksum) if entry.checksum else b''
+            f.write(RECORD.pack(shared, len(suffix), len(nevra), len(checksum_type), len(digest),
+                                entry.size or 0))
+            f.write(suffix + nevra + checksum_type + digest)
+            previous = path_bytes
+    os.rename(tmp_path, path)
+
+def read(path):
+    """ Yield the entries of a manifest, sorted by path. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a manifest'.format(path))
+        buf = b''
+        offset = 0
+        previous = b''
+        while True:
+            if len(buf) - offset < RECORD.size:
+                buf = buf[offset:] + f.read(READ_SIZE)
+                offset = 0
+                if not buf:
+                    return
+                if len(buf) < RECORD.size:
+                    raise ValueError('{} is truncated'.format(path))
+            shared, suffix_len, nevra_len, type_len, digest_len, size = RECORD.unpack_from(buf, offset)
+            length = RECORD.size + suffix_len + nevra_len + type_len + digest_len
+            while len(buf) - offset < length:
+                data = f.read(READ_SIZE)
+                if not data:
+                    raise ValueError('{} is truncated'.format(path))
+                buf = buf[offset:] + data
+                offset = 0
+            pos = offset + RECORD.size
+            path_bytes = previous[:shared] + buf[pos:pos + suffix_len]
+            pos += suffix_len
+            nevra = buf[pos:pos + nevra_len].decode('utf-8')
+            pos += nevra_len
+            checksum_type = buf[pos:pos + type_len].decode('ascii')
+            pos += type_len
+            checksum = binascii.hexlify(buf[pos:pos + digest_len]).decode('ascii')
+            offset += length
+            previous = path_bytes
+            yield Entry(path_bytes.decode('utf-8'), nevra or None, size if digest_len else None,
+                        checksum_type or None, checksum or None)
+
+def read_filelist(path):
+    """ Yield the entries of a filelist, sorted by path, without details. """
+    with open(path, 'r') as f:
+        paths = sorted(line.rstrip('\n') for line in f if line.strip())
+    for package in paths:
+        yield Entry(package, None, None, None, None)
+
+def open_snapshot(snapshot_dir):
+    """ Yield the entries of a snapshot, from its manifest or else its filelist. """
+    if os.path.exists(os.path.join(snapshot_dir, MANIFEST)):
+        return read(os.path.join(snapshot_dir, MANIFEST))
+    if os.path.exists(os.path.join(snapshot_dir, FILELIST)):
+        return read_filelist(os.path.join(snapshot_dir, FILELIST))
+    raise ValueError('{} has neither a {} nor a {}'.format(snapshot_dir, MANIFEST, FILELIST))
+
+def diff(old, new):
+    """ Merge two sorted streams of entries, yielding (status, old, new).
+
+    status is '-' for entries only in old, '+' for entries only in new and
+    '~' for paths whose content changed. Content is compared when both sides
+    have a checksum.
+    """
+    old_entry = next(old, None)
+    new_entry = next(new, None)
+    while old_entry is not None or new_entry is not None:
+        old_key = old_entry.path if old_entry is not None else None
+        new_key = new_entry.path if new_entry is not None else None
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield '-', old_entry, None
+            old_entry = next(old, None)
+        elif old_key is None or new_key < old_key:
+            yield '+', None, new_entry
+            new_entry = next(new, None)
+        else:
+            if (old_entry.checksum and new_entry.checksum and
+                    (old_entry.checksum_type, old_entry.checksum) != (new_entry.checksum_type, new_entry.checksum)):
+                yield '~', old_entry, new_entry
+            old_entry = next(old, None)
+            new_entry = next(new, None)
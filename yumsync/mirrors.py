@@ -0,0 +1,137 @@
+""" Mirror scoring for repositories configured with a mirrorlist.
+
+Mirrors are ranked by the throughput they delivered in previous runs, kept
+in a small JSON history next to the repository state, and by a short range
+request probing them before downloads start.
+"""
+import logging
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from yumsync import util
+
+# bytes read from each probed mirror
+PROBE_SIZE = 256 * 1024
+# mirrors probed per run, the best known ones first
+PROBE_MIRRORS = 8
+# weight of the newest sample in the throughput average
+SMOOTHING = 0.3
+# downloads are spread over this many of the best mirrors
+SPREAD = 3
+
+class MirrorHistory(object):
+    """ Persistent throughput history of the mirrors of a repository. """
+    def __init__(self, path):
+        self.path = path
+        self.mirrors = util.load_json(path, {})
+
+    def record(self, mirror, nbytes, seconds, ok=True):
+        """ Add a transfer sample, or a failure when ok is False. """
+        entry = self.mirrors.setdefault(mirror, {'rate': None, 'failures': 0})
+        if not ok:
+            entry['failures'] += 1
+            return
+        entry['failures'] = max(0, entry['failures'] - 1)
+        rate = nbytes / max(seconds, 0.001)
+        if entry['rate'] is None:
+            entry['rate'] = rate
+        else:
+            entry['rate'] = SMOOTHING * rate + (1 - SMOOTHING) * entry['rate']
+        entry['updated'] = int(time.time())
+
+    def score(self, mirror):
+        """ Expected bytes per second of a mirror, halved per recent failure. """
+        entry = self.mirrors.get(mirror)
+        if entry is None or entry['rate'] is None:
+            return None
+        return entry['rate'] / (2 ** entry['failures'])
+
+    def rank(self, mirrors):
+        """ Order mirrors from fastest to slowest.
+
+        Mirrors without samples come next, those that only ever failed last.
+        """
+        known = [m for m in mirrors if self.score(m) is not None]
+        unknown = [m for m in mirrors if self.score(m) is None]
+        failing = [m for m in unknown if self.mirrors.get(m, {}).get('failures')]
+        return (sorted(known, key=self.score, reverse=True) +
+                [m for m in unknown if m not in failing] + failing)
+
+    def healthy(self, mirrors):
+        """ Mirrors which delivered packages, fastest first. """
+        return [m for m in self.rank(mirrors) if self.score(m) is not None]
+
+    def save(self):
+        util.save_json(self.path, self.mirrors)
+
+def read_mirrorlist(path):
+    """ Return the mirrors of a mirrorlist or metalink file, in its order.
+
+    Metalinks list the URL of repomd.xml, which is stripped to the
+    repository root. A missing or unreadable file has no mirrors.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return []
+    if b'<metalink' in data:
+        try:
+            root = ElementTree.fromstring(data)
+        except ElementTree.ParseError as e:
+            logging.warning('{}: {}'.format(path, e))
+            return []
+        urls = [el.text.strip() for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'url' and el.text]
+    else:
+        urls = [line.strip() for line in data.decode('utf-8', 'replace').splitlines()]
+    mirrors = []
+    for url in urls:
+        if not url.startswith(('http://', 'https://', 'ftp://', 'file://')):
+            continue
+        if url.endswith('repodata/repomd.xml'):
+            url = url[:-len('repodata/repomd.xml')]
+        if url not in mirrors:
+            mirrors.append(url)
+    return mirrors
+
+def probe(downloader, mirrors, location, history):
+    """ Time a small range request of location against the best mirrors.
+
+    Probes run in parallel and every result, failures included, goes into
+    history.
+    """
+    candidates = history.rank(mirrors)[:PROBE_MIRRORS]
+
+    def probe_one(mirror):
+        url = '{}/{}'.format(mirror.rstrip('/'), location.lstrip('/'))
+        start = time.time()
+        nbytes = 0
+        try:
+            response = downloader.open(url, {'Range': 'bytes=0-{:d}'.format(PROBE_SIZE - 1)})
+            try:
+                while nbytes < PROBE_SIZE:
+                    chunk = response.read(PROBE_SIZE - nbytes)
+                    if not chunk:
+                        break
+                    nbytes += len(chunk)
+            finally:
+                response.close()
+        except Exception as e:
+            logging.info('probe of {} failed ({})'.format(mirror, e))
+            return mirror, 0, 0, False
+        return mirror, nbytes, time.time() - start, True
+
+    with ThreadPoolExecutor(max_workers=len(candidates) or 1) as executor:
+        for mirror, nbytes, seconds, ok in executor.map(probe_one, candidates):
+            history.record(mirror, nbytes, seconds, ok)
+
+def spread(mirrors, index, width=SPREAD):
+    """ Mirror order for the index-th package.
+
+    Packages rotate over the width first mirrors, so they share the load,
+    with the remaining mirrors kept as fallbacks.
+    """
+    width = max(1, min(width, len(mirrors)))
+    shift = index % width
+    return mirrors[shift:width] + mirrors[:shift] + mirrors[width:]
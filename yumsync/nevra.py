@@ -0,0 +1,45 @@
+""" Index of packages by NEVRA, for deduplication and retention. """
+import collections
+from functools import cmp_to_key
+
+import rpm
+
+class NevraIndex(object):
+    """ Packages indexed by NEVRA and grouped by name and arch.
+
+    Packages are added in order of preference: a package whose NEVRA is
+    already indexed is refused. Packages without a known NEVRA are kept
+    as they are.
+    """
+    def __init__(self):
+        self._paths = []
+        self._nevras = set()
+        self._name_arch = collections.defaultdict(list)
+
+    def add(self, path, nevra):
+        """ Index a package, returning False if its NEVRA is a duplicate. """
+        if nevra is None:
+            self._paths.append(path)
+            return True
+        evr = (str(nevra['epoch'] or 0), nevra['version'], nevra['release'])
+        key = (nevra['name'], nevra['arch']) + evr
+        if key in self._nevras:
+            return False
+        self._nevras.add(key)
+        self._paths.append(path)
+        self._name_arch[(nevra['name'], nevra['arch'])].append((evr, path))
+        return True
+
+    def retain(self, keep=None):
+        """ Return the indexed packages, with at most keep versions per name.arch.
+
+        The newest versions are kept, compared the way rpm does.
+        """
+        if keep is None:
+            return list(self._paths)
+        dropped = set()
+        for versions in self._name_arch.values():
+            if len(versions) > keep:
+                versions.sort(key=cmp_to_key(lambda a, b: rpm.labelCompare(a[0], b[0])), reverse=True)
+                dropped.update(path for _, path in versions[keep:])
+        return [path for path in self._paths if path not in dropped]
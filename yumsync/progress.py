@@ -4,7 +4,6 @@ import itertools
 from blessings import Terminal
 import logging
 import six
-import dnf
 
 class Progress(object):
     """ Handle progress indication using callbacks.
@@ -15,19 +14,19 @@ class Progress(object):
     the status of the repository metadata. This makes it possible to
     display aggregated status of multiple repositories during a sync.
     """
-    repos = {}
-    totals = {
-        'numpkgs': 0,
-        'dlpkgs': 0,
-        'md_complete': 0,
-        'md_total': 0,
-        'errors':0
-    }
-    errors = []
-
     def __init__(self):
         """ records the time the sync started.
             and initialise blessings terminal """
+        # per instance, --watch builds a new one for every run
+        self.repos = {}
+        self.totals = {
+            'numpkgs': 0,
+            'dlpkgs': 0,
+            'md_complete': 0,
+            'md_total': 0,
+            'errors':0
+        }
+        self.errors = []
         self.start = datetime.datetime.now()
         self.linecount = 0
         if sys.stdout.isatty():
@@ -63,11 +62,11 @@ class Progress(object):
             self.totals['dlpkgs'] += pkgs_downloaded
         if repo_metadata:
             self.repos[repo_id]['repomd'] = repo_metadata
-            if repo_metadata == 'complete':
+            if repo_metadata in ('complete', 'unchanged'):
                 self.totals['md_complete'] += 1
         if repo_error:
             self.totals['errors'] += 1
-            if self.repos[repo_id]['repomd'] != 'complete':
+            if self.repos[repo_id]['repomd'] not in ('complete', 'unchanged'):
                 self.totals['md_total'] -= 1
             self.errors.append((repo_id, repo_error))
 
@@ -206,7 +205,7 @@ class Progress(object):
             if isinstance(metadata, int):
                 metadata = "{}%".format(metadata)
             metadata = self.color(metadata, 'yellow')
-        elif metadata == 'complete':
+        elif metadata in ('complete', 'unchanged'):
             metadata = self.color(metadata, 'green')
         return self.format_line(repo, packages, percent, metadata)
 
@@ -266,7 +265,7 @@ class Progress(object):
         for repo_id in sorted(self.repos):
             if 'error' in self.repos[repo_id]:
                 error_repos.append(repo_id)
-            elif self.repos[repo_id]['repomd'] == 'complete':
+            elif self.repos[repo_id]['repomd'] in ('complete', 'unchanged'):
                 complete_repos.append(repo_id)
             elif self.repos[repo_id]['repomd']:
                 metadata_repos.append(repo_id)
@@ -417,6 +416,10 @@ class ProgressCallback(object):
         """ Called when a repository completes downloading all packages. """
         self.send(repo_id, 'repo_complete')
 
+    def repo_unchanged(self, repo_id):
+        """ Called when a repository is skipped because nothing changed. """
+        self.send(repo_id, 'repo_unchanged')
+
     def repo_error(self, repo_id, error):
         """ Called when a repository throws an exception. """
         self.send(repo_id, 'repo_error', error)
@@ -425,25 +428,22 @@ class ProgressCallback(object):
         """ Called when a download will be skipped because it already exists """
         self.send(repo_id, 'pkg_exists', pkgname)
 
+    def pkgs_exist(self, repo_id, pkgnames):
+        """ Called with a batch of packages found valid on disk """
+        self.send(repo_id, 'pkgs_exist', pkgnames)
+
     def delete_pkg(self, repo_id, pkgname):
         """ Called when a package is deleted from a repository """
         self.send(repo_id, 'delete_pkg', pkgname)
 
+    def prune_summary(self, repo_id, count, reclaimable, dry_run):
+        """ Called once packages no longer in a repository were (or would be) deleted """
+        self.send(repo_id, 'prune_summary', count, reclaimable, dry_run)
+
+    def download_end(self, repo_id, pkgname, size):
+        """ Called when a package finishes downloading """
+        self.send(repo_id, 'download_end', pkgname, size)
+
     def link_local_pkg(self, repo_id, pkgname, size):
         """ Called when a package is linked from a local repository """
         self.send(repo_id, 'link_local_pkg', pkgname, size)
-
-class DownloadProgress(dnf.callback.DownloadProgress):
-    def __init__(self, callback):
-        self.callback = callback
-
-    def start(self, total_files, total_size, total_drpms=0):
-        self.callback('repo_init', total_files)
-
-    def progress(self, payload, done):
-        pass
-
-    def end(self, payload, status, msg):
-        file_name = payload.__str__()
-        if status == dnf.callback.STATUS_OK:
-            self.callback('pkg_exists', file_name)
@@ -0,0 +1,52 @@
+""" Compact, serializable records of createrepo_c packages.
+
+A record is a plain dict holding every attribute of a createrepo_c Package,
+so it can be stored in a cache or sent between processes and turned back
+into a Package ready to be added to the metadata writers.
+"""
+import createrepo_c as createrepo
+
+SCALAR_ATTRS = (
+    'pkgId', 'name', 'arch', 'version', 'epoch', 'release', 'summary',
+    'description', 'url', 'time_file', 'time_build', 'rpm_license',
+    'rpm_vendor', 'rpm_group', 'rpm_buildhost', 'rpm_sourcerpm',
+    'rpm_header_start', 'rpm_header_end', 'rpm_packager', 'size_package',
+    'size_installed', 'size_archive', 'location_base', 'checksum_type',
+)
+
+LIST_ATTRS = (
+    'requires', 'provides', 'conflicts', 'obsoletes', 'suggests', 'enhances',
+    'recommends', 'supplements', 'files', 'changelogs',
+)
+
+def package_to_record(pkg):
+    """ Convert a createrepo_c Package into a record. """
+    record = {}
+    for attr in SCALAR_ATTRS:
+        if hasattr(pkg, attr):
+            record[attr] = getattr(pkg, attr)
+    for attr in LIST_ATTRS:
+        if hasattr(pkg, attr):
+            record[attr] = [list(item) for item in getattr(pkg, attr)]
+    return record
+
+def package_from_record(record, href=None):
+    """ Build a createrepo_c Package from a record. """
+    pkg = createrepo.Package()
+    for attr in SCALAR_ATTRS:
+        if attr in record:
+            setattr(pkg, attr, record[attr])
+    for attr in LIST_ATTRS:
+        if attr in record:
+            setattr(pkg, attr, [tuple(item) for item in record[attr]])
+    if href is not None:
+        pkg.location_href = href
+    return pkg
+
+def parse_package(filename):
+    """ Read an RPM and return its record.
+
+    This is a module level function so it can be handed to a process pool,
+    the returned record is much cheaper to send back than XML.
+    """
+    return package_to_record(createrepo.package_from_rpm(filename))
@@ -0,0 +1,84 @@
+""" Scanning of local directories for packages.
+
+Directories are listed with os.scandir by a pool of threads, which keeps
+many requests in flight on network filesystems, and the file names are
+matched against the include and exclude globs compiled into a single
+regular expression each.
+"""
+import fnmatch
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# directories listed in parallel
+SCAN_WORKERS = 8
+
+class GlobMatcher(object):
+    """ Match file names against include and exclude globs.
+
+    A name matches when it matches no exclude glob and, if there are include
+    globs, at least one of them.
+    """
+    def __init__(self, include=None, exclude=None):
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    @staticmethod
+    def _compile(globs):
+        if not globs:
+            return None
+        return re.compile('|'.join('(?:{})'.format(fnmatch.translate(glob)) for glob in globs))
+
+    def match(self, name):
+        if self._exclude is not None and self._exclude.match(name):
+            return False
+        return self._include is None or self._include.match(name) is not None
+
+def _scan_dir(path, root, matcher):
+    files = []
+    dirs = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return files, dirs
+    for entry in entries:
+        try:
+            # symlinks are followed, like the files they point to
+            if entry.is_dir():
+                dirs.append((entry.path, entry.stat()))
+            elif entry.name.endswith('.rpm') and matcher.match(entry.name):
+                files.append((os.path.relpath(entry.path, root), entry.stat()))
+        except OSError:
+            # dangling symlink
+            continue
+    return files, dirs
+
+def find_rpms(directory, matcher, workers=SCAN_WORKERS):
+    """ Return the sorted (relative path, stat) of the matching RPMs under directory.
+
+    Symlinked directories are followed, each directory is only listed once.
+    Directories are listed a level at a time, and a directory reachable
+    through several paths is listed through the shallowest one, the smallest
+    path among those, so the result does not depend on the order the threads
+    finish in.
+    """
+    found = []
+    try:
+        st = os.stat(directory)
+    except OSError:
+        return found
+    seen = set([(st.st_dev, st.st_ino)])
+    level = [directory]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            subdirs = []
+            for files, dirs in executor.map(lambda path: _scan_dir(path, directory, matcher), level):
+                found.extend(files)
+                subdirs.extend(dirs)
+            level = []
+            for path, st in sorted(subdirs, key=lambda item: item[0]):
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    level.append(path)
+    found.sort()
+    return found
@@ -0,0 +1,188 @@
+""" Retention and garbage collection of the versioned snapshots of a repository.
+
+Snapshots are the version directories of a repository, each with the
+filelist of the packages it references. Retention policies expire snapshots,
+and the packages referenced by no remaining snapshot are deleted along with
+them. Space is accounted per inode, so a package hardlinked into several
+snapshots, or into the store, only counts once all its links are deleted.
+"""
+import collections
+import errno
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FILELIST = 'filelist'
+# directories of a repository which are not snapshots
+RESERVED = ('packages', 'repodata', '.yumsync')
+# entries of a directory marking it as a snapshot
+MARKERS = (FILELIST, 'packages', 'repodata')
+DELETE_BATCH = 256
+
+class Snapshot(object):
+    """ A version directory. Snapshots without a filelist are incomplete. """
+    def __init__(self, version, path, mtime, complete):
+        self.version = version
+        self.path = path
+        self.mtime = mtime
+        self.complete = complete
+
+    def packages(self):
+        """ Return the packages referenced by the snapshot, relative to the package directory. """
+        packages = set()
+        with open(os.path.join(self.path, FILELIST), 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('packages/'):
+                    packages.add(line[len('packages/'):])
+        return packages
+
+def find_snapshots(repo_dir):
+    """ Return the snapshots of a repository, newest first. """
+    snapshots = []
+    pending = ['']
+    while pending:
+        version = pending.pop()
+        path = os.path.join(repo_dir, version)
+        try:
+            entries = dict((entry.name, entry) for entry in os.scandir(path))
+        except OSError:
+            continue
+        if version and any(marker in entries for marker in MARKERS):
+            filelist = entries.get(FILELIST)
+            if filelist is not None and filelist.is_file(follow_symlinks=False):
+                snapshots.append(Snapshot(version, path, filelist.stat(follow_symlinks=False).st_mtime, True))
+            else:
+                snapshots.append(Snapshot(version, path, os.lstat(path).st_mtime, False))
+            continue
+        for name, entry in entries.items():
+            if not version and name in RESERVED:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(os.path.join(version, name))
+    snapshots.sort(key=lambda s: (s.mtime, s.version), reverse=True)
+    return snapshots
+
+def pinned_versions(repo_dir, snapshots, versions=()):
+    """ Return the versions targeted by links of the repository (latest,
+    stable and labels), along with versions.
+    """
+    known = set(s.version for s in snapshots)
+    pinned = set(v for v in versions if v)
+    for entry in os.scandir(repo_dir):
+        if not entry.is_symlink():
+            continue
+        target = os.path.normpath(os.path.join(repo_dir, os.readlink(entry.path)))
+        version = os.path.relpath(target, os.path.normpath(repo_dir))
+        if version in known:
+            pinned.add(version)
+    return pinned
+
+class Plan(object):
+    """ The snapshots and packages a collection deletes, and the space it reclaims. """
+    def __init__(self, snapshots, packages, reclaimable):
+        self.snapshots = snapshots
+        self.packages = packages
+        self.reclaimable = reclaimable
+
+def _files(top, path=''):
+    """ Yield the relative path and lstat of the regular files under top, not following symlinks. """
+    try:
+        entries = list(os.scandir(os.path.join(top, path)))
+    except OSError:
+        return
+    for entry in entries:
+        name = os.path.join(path, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            for item in _files(top, name):
+                yield item
+        elif entry.is_file(follow_symlinks=False):
+            yield name, entry.stat(follow_symlinks=False)
+
+def plan(repo_dir, package_dir, keep=None, newer_than=None, pinned=(), now=None):
+    """ Plan the collection of the snapshots of a repository.
+
+    Snapshots are kept if they are among the keep newest, newer than
+    newer_than seconds, or pinned by a link or in pinned. Without any policy
+    nothing is collected. Incomplete snapshots are always kept, and while
+    there are any, packages are left alone as their references are unknown.
+    """
+    if keep is None and newer_than is None:
+        return Plan([], [], 0)
+    now = time.time() if now is None else now
+    snapshots = find_snapshots(repo_dir)
+    pinned = pinned_versions(repo_dir, snapshots, pinned)
+
+    expired, kept = [], []
+    for idx, snapshot in enumerate(snapshots):
+        if (not snapshot.complete or snapshot.version in pinned
+                or (keep is not None and idx < keep)
+                or (newer_than is not None and snapshot.mtime >= now - newer_than)):
+            kept.append(snapshot)
+        else:
+            expired.append(snapshot)
+
+    # count the links deleted per inode, space is reclaimed once all are gone
+    links = collections.Counter()
+    inodes = {}
+    def account(st):
+        key = (st.st_dev, st.st_ino)
+        links[key] += 1
+        inodes[key] = st
+
+    for snapshot in expired:
+        for _, st in _files(snapshot.path):
+            account(st)
+
+    packages = []
+    incomplete = [s.version for s in kept if not s.complete]
+    if incomplete:
+        logging.warning('{}: snapshots without {} ({}), not collecting packages'.format(
+            repo_dir, FILELIST, ', '.join(sorted(incomplete))))
+    elif not os.path.islink(package_dir):
+        referenced = set()
+        for snapshot in kept:
+            referenced.update(snapshot.packages())
+        for name, st in _files(package_dir):
+            if name not in referenced:
+                packages.append(name)
+                account(st)
+        packages.sort()
+
+    reclaimable = sum(st.st_size for key, st in inodes.items() if links[key] >= st.st_nlink)
+    return Plan(expired, packages, reclaimable)
+
+def _remove_empty_dirs(top, path):
+    """ Remove path and its parents below top, as long as they are empty. """
+    top = os.path.normpath(top)
+    path = os.path.normpath(path)
+    while path.startswith(top + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+def collect(repo_dir, package_dir, collection, workers=1):
+    """ Delete the snapshots and packages of a plan. """
+    def unlink_batch(batch):
+        for name in batch:
+            try:
+                os.unlink(os.path.join(package_dir, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    names = collection.packages
+    batches = [names[i:i + DELETE_BATCH] for i in range(0, len(names), DELETE_BATCH)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(unlink_batch, batches))
+        # rmtree does not follow the package links of symlinked snapshots
+        list(executor.map(shutil.rmtree, [s.path for s in collection.snapshots]))
+    for snapshot in collection.snapshots:
+        _remove_empty_dirs(repo_dir, os.path.dirname(snapshot.path))
+    for subdir in set(os.path.dirname(name) for name in names):
+        if subdir:
+            _remove_empty_dirs(package_dir, os.path.join(package_dir, subdir))
@@ -0,0 +1,66 @@
+import errno
+import os
+
+from yumsync import util
+
+class PackageStore(object):
+    """ Content-addressable store of packages shared by every repository.
+
+    Packages are kept once per checksum under
+    <path>/<checksum type>/<first two hex digits>/<checksum>.rpm and the
+    packages directories of repositories hold hardlinks to them, so a
+    package only takes space and bandwidth once on the whole mirror.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def path_for(self, checksum_type, checksum):
+        return os.path.join(self.path, checksum_type, checksum[:2], '{}.rpm'.format(checksum))
+
+    def link_out(self, checksum_type, checksum, target):
+        """ Link a stored package to target, returning False if not stored. """
+        stored = self.path_for(checksum_type, checksum)
+        if not os.path.exists(stored):
+            return False
+        try:
+            util.hardlink(stored, target)
+        except Exception:
+            # different device, reflink where the filesystem is shared
+            return self._clone(stored, target)
+        return True
+
+    def add(self, checksum_type, checksum, source):
+        """ Store a verified package, or replace source by the stored copy.
+
+        Packages on another device than the store are reflinked into it where
+        possible, and otherwise only kept in their repository.
+        """
+        stored = self.path_for(checksum_type, checksum)
+        util.make_dir(os.path.dirname(stored))
+        try:
+            os.link(source, stored)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                try:
+                    util.hardlink(stored, source)
+                except Exception:
+                    # different device, keep the local copy
+                    pass
+            elif e.errno == errno.EXDEV:
+                self._clone(source, stored)
+            else:
+                raise
+
+    @staticmethod
+    def _clone(source, target):
+        """ Reflink source to target through a temporary file, returning False where unsupported. """
+        tmp = os.path.join(os.path.dirname(target), '.{}.tmp'.format(os.path.basename(target)))
+        try:
+            util.make_dir(os.path.dirname(target))
+            util.reflink(source, tmp)
+            os.rename(tmp, target)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            return False
+        return True
@@ -22,7 +22,9 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, tempfile, shutil
+import os, tempfile, shutil, fcntl, json, hashlib, errno
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 try:
     from weakref import finalize
@@ -35,6 +37,59 @@ def make_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
+@contextmanager
+def lock(path):
+    """ Hold an exclusive lock on a file for the duration of the context.
+    Other processes locking the same path block until it is released.
+    """
+    make_dir(os.path.dirname(path))
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def file_checksum(path, sumtype='sha256', blocksize=1024 * 1024):
+    """ Return the hex digest of a file. """
+    digest = hashlib.new(sumtype)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_size(value):
+    """ Convert a size such as 512k, 10M or 1G (or a number) to bytes. """
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = str(value).strip()
+    if value and value[-1].lower() in units:
+        return int(float(value[:-1]) * units[value[-1].lower()])
+    return int(float(value))
+
+def parse_duration(value):
+    """ Convert a duration such as 90m, 12h, 30d or 2w (or a number of seconds) to seconds. """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    value = str(value).strip()
+    if value and value[-1].lower() in units:
+        return float(value[:-1]) * units[value[-1].lower()]
+    return float(value)
+
+def load_json(path, default=None):
+    """ Read a JSON state file, returning default if missing or unreadable. """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def save_json(path, data):
+    """ Atomically replace a JSON state file. """
+    make_dir(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmp_path, path)
+
 # path = path to symlink
 # target = path to real file
 def symlink(path, target):
@@ -91,6 +146,221 @@ def hardlink(source, target):
             os.link(source, target)
             return True
 
+def _list_dir(path):
+    try:
+        return dict((entry.name, entry) for entry in os.scandir(path))
+    except OSError:
+        return {}
+
+def _plan_links(source_dir, target_dir, names, current, kind, same_device=True):
+    """ Return the names missing from target_dir or not current, from one
+    listing of each directory, along with the subdirectories on the same
+    device as their source. Raises if a source is missing, or if same_device
+    and a subdirectory is on another device.
+    """
+    groups = {}
+    for name in names:
+        groups.setdefault(os.path.dirname(name), []).append(name)
+    todo = []
+    shared = set()
+    for subdir, group in groups.items():
+        source_subdir = os.path.join(source_dir, subdir)
+        target_subdir = os.path.join(target_dir, subdir)
+        make_dir(target_subdir)
+        source_dev = os.stat(source_subdir).st_dev
+        target_dev = os.stat(target_subdir).st_dev
+        if source_dev == target_dev:
+            shared.add(subdir)
+        elif same_device:
+            raise Exception('source device %s is not equal to target device %s - Cannot create %s' %
+                            (source_dev, target_dev, kind))
+        sources = _list_dir(source_subdir)
+        targets = _list_dir(target_subdir)
+        for name in group:
+            base = os.path.basename(name)
+            if base not in sources:
+                raise Exception('%s does not exist - Cannot create %s' % (os.path.join(source_dir, name), kind))
+            target = targets.get(base)
+            if target is None:
+                todo.append((name, False))
+            elif target.is_symlink() or not current(sources[base], target):
+                todo.append((name, True))
+    return todo, shared
+
+def _run(func, items, workers):
+    if workers > 1 and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(func, items))
+    else:
+        for item in items:
+            func(item)
+
+def hardlink_many(source_dir, target_dir, names, workers=1):
+    """ Hardlink names (relative paths) from source_dir into target_dir.
+
+    The result is the same as hardlink() for each name, but each directory
+    is listed once and devices are compared once per directory, so only the
+    missing or outdated entries cost a link(2). Returns the linked names.
+    """
+    def current(source, target):
+        return target.inode() == source.inode() or os.path.samefile(source.path, target.path)
+
+    todo, _ = _plan_links(source_dir, target_dir, names, current, 'hardlink')
+
+    def link(item):
+        name, replace = item
+        target = os.path.join(target_dir, name)
+        if replace:
+            os.unlink(target)
+        os.link(os.path.join(source_dir, name), target)
+
+    _run(link, todo, workers)
+    return [name for name, _ in todo]
+
+def _scan_links(top, path=''):
+    """ Return the symlinks (relative paths) and other files under top, and its subdirectories. """
+    links, others, dirs = {}, set(), [path]
+    for entry in _list_dir(os.path.join(top, path)).values():
+        name = os.path.join(path, entry.name)
+        if entry.is_symlink():
+            links[name] = entry
+        elif entry.is_dir(follow_symlinks=False):
+            sub_links, sub_others, sub_dirs = _scan_links(top, name)
+            links.update(sub_links)
+            others.update(sub_others)
+            dirs.extend(sub_dirs)
+        else:
+            others.add(name)
+    return links, others, dirs
+
+def symlink_tree(top, links):
+    """ Make the symlinks under top exactly links, a dict of relative paths to targets.
+
+    The tree is scanned once and only the difference is applied: missing
+    links are created, links that are not wanted anymore are removed, along
+    with directories they leave empty. Files which are not symlinks, left by
+    another link type, are removed or replaced by their link. Existing links
+    are trusted to point to their target when a sample link of their
+    directory does, so unchanged links cost no readlink(2). Returns the
+    created and removed paths.
+    """
+    existing, others, dirs = _scan_links(top)
+    for name in others:
+        os.unlink(os.path.join(top, name))
+
+    stale = set(name for name in existing if name not in links)
+    checked = {}
+    for name in sorted(set(existing) & set(links)):
+        directory = os.path.dirname(name)
+        if checked.get(directory, False):
+            continue
+        # sample the first link of each directory, check every link of it on mismatch
+        current = os.readlink(existing[name].path) == links[name]
+        if not current:
+            stale.add(name)
+        if directory not in checked:
+            checked[directory] = current
+
+    create = sorted(name for name in links if name not in existing or name in stale or name in others)
+    for name in sorted(stale):
+        os.unlink(os.path.join(top, name))
+    for name in create:
+        path = os.path.join(top, name)
+        make_dir(os.path.dirname(path))
+        os.symlink(links[name], path)
+
+    _remove_unwanted_dirs(top, dirs, links)
+    return create, sorted(name for name in stale | others if name not in links)
+
+def _remove_unwanted_dirs(top, dirs, names):
+    """ Remove the directories under top holding none of names, if empty. """
+    wanted = set()
+    for name in names:
+        while name:
+            name = os.path.dirname(name)
+            wanted.add(name)
+    for directory in sorted(dirs, reverse=True):
+        if directory and directory not in wanted:
+            try:
+                os.rmdir(os.path.join(top, directory))
+            except OSError:
+                pass
+
+def prune_tree(top, names):
+    """ Remove the files under top which are not in names (relative paths).
+
+    Symlinks are removed as well, so hardlink_many() or reflink_many() can
+    replace them by files, along with directories left empty. The tree is
+    scanned once. Returns the removed paths.
+    """
+    if not os.path.isdir(top):
+        return []
+    links, others, dirs = _scan_links(top)
+    names = set(names)
+    stale = sorted(set(links) | set(name for name in others if name not in names))
+    for name in stale:
+        os.unlink(os.path.join(top, name))
+    _remove_unwanted_dirs(top, dirs, names)
+    return stale
+
+# ioctl cloning a whole file, from linux/fs.h
+FICLONE = 0x40049409
+# errors meaning the filesystem or the pair of files can not share extents
+REFLINK_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS)
+
+def reflink(source, target):
+    """ Clone source to target, sharing its extents on copy-on-write
+    filesystems such as btrfs or XFS. Raises OSError where unsupported.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
+
+def reflink_many(source_dir, target_dir, names, workers=1):
+    """ Reflink names (relative paths) from source_dir into target_dir.
+
+    Targets are independent files, cloned where the filesystem supports it.
+    Otherwise they are hardlinked when on the same device, or copied. Each
+    directory is listed once, and entries of the same size and mtime as their
+    source, or hardlinked to it, are left alone. Returns the linked names.
+    """
+    def current(source, target):
+        if target.inode() == source.inode():
+            return True
+        source_stat, target_stat = source.stat(), target.stat(follow_symlinks=False)
+        return source_stat.st_size == target_stat.st_size and source_stat.st_mtime == target_stat.st_mtime
+
+    todo, shared = _plan_links(source_dir, target_dir, names, current, 'reflink', same_device=False)
+    clone = [True]
+
+    def link(item):
+        name, _ = item
+        source = os.path.join(source_dir, name)
+        target = os.path.join(target_dir, name)
+        tmp = os.path.join(os.path.dirname(target), '.{}.tmp'.format(os.path.basename(name)))
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            if not clone[0]:
+                raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+            reflink(source, tmp)
+        except (IOError, OSError) as e:
+            if e.errno not in REFLINK_UNSUPPORTED:
+                raise
+            if e.errno != errno.EXDEV:
+                # the filesystem can not clone, do not try again
+                clone[0] = False
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            if os.path.dirname(name) in shared:
+                os.link(source, tmp)
+            else:
+                shutil.copy2(source, tmp)
+        os.rename(tmp, target)
+
+    _run(link, todo, workers)
+    return [name for name, _ in todo]
+
 # Reused from python3 stdlib for Python2/Python3 compat
 class TemporaryDirectory(object):
     """Create and return a temporary directory.  This has the same
@@ -0,0 +1,147 @@
+""" Watch the directories of local repositories for new or removed packages.
+
+Linux inotify is used through ctypes. Whole trees are watched, including
+directories created later, and bursts of changes are debounced so a CI job
+dropping many packages at once triggers a single rebuild.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+# seconds without changes before a burst is considered over
+DEBOUNCE = 2
+# longest a continuous stream of changes delays a rebuild, in seconds
+MAX_DELAY = 30
+
+class Inotify(object):
+    """ Minimal inotify binding. """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """ Watch path, returning its watch descriptor. """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """ Wait up to timeout seconds for events, returned as (wd, mask, name). """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """ Watch the trees of local repositories.
+
+    dirs maps repository ids to the directories holding their packages.
+    """
+    def __init__(self, dirs):
+        self._inotify = Inotify()
+        self._repos = {}
+        for repo_id, repo_dirs in dirs.items():
+            for directory in repo_dirs:
+                self._watch_tree(directory, set([repo_id]))
+
+    def _watch_tree(self, top, repo_ids):
+        # symlinks are followed, each directory only once so link cycles end
+        seen = set()
+        for root, dirnames, _ in os.walk(top, followlinks=True):
+            try:
+                st = os.stat(root)
+            except OSError:
+                dirnames[:] = []
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                dirnames[:] = []
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            try:
+                wd = self._inotify.add_watch(root)
+            except OSError as e:
+                logging.warning('unable to watch {} ({})'.format(root, e))
+                continue
+            self._repos.setdefault(wd, set()).update(repo_ids)
+
+    def wait(self):
+        """ Block until packages changed and settled, returning the ids of their repositories. """
+        changed = set()
+        deadline = None
+        while True:
+            timeout = None
+            if changed:
+                timeout = min(DEBOUNCE, deadline - time.time())
+                if timeout <= 0:
+                    return changed
+            events = self._inotify.read(timeout)
+            if not events and changed:
+                return changed
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, rebuild everything
+                    for repo_ids in self._repos.values():
+                        changed.update(repo_ids)
+                    continue
+                repo_ids = self._repos.get(wd)
+                if not repo_ids:
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and wd in self._inotify.paths:
+                        self._watch_tree(os.path.join(self._inotify.paths[wd], name), repo_ids)
+                    changed.update(repo_ids)
+                elif name.endswith('.rpm') or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    changed.update(repo_ids)
+            if changed and deadline is None:
+                deadline = time.time() + MAX_DELAY
+
+    def close(self):
+        self._inotify.close()
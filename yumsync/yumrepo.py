@@ -13,24 +13,39 @@ except ImportError:
     # Python3
     from urllib.parse import urlparse
 
+import binascii
 import copy
+import errno
+import hashlib
+import json
 import os
-import bisect
-from fnmatch import fnmatch
 import shutil
+import stat
 import sys
 import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 # third-party imports
 import createrepo_c as createrepo
-import dnf, libdnf, rpm
+import dnf, hawkey, libdnf
 import six
 import yumsync.util as util
 import logging
 
-from yumsync import progress
-
-from threading import Lock
+from yumsync import delta, download, headers, manifest, mirrors, records, scan, snapshots
+from yumsync.cache import HeaderIndex, PackageCache, VerificationLedger
+from yumsync.nevra import NevraIndex
+from yumsync.store import PackageStore
+
+# valid packages reported per pkgs_exist event
+PROGRESS_BATCH = 256
+# packages sent at once to a header validation worker
+VALIDATE_CHUNK = 64
+# packages unlinked at once by a prune worker
+PRUNE_BATCH = 256
+# options which change how a sync runs, not what it produces
+RUNTIME_OPTS = ('cachedir', 'metadata_expire', 'download_workers', 'host_connections', 'weight',
+                'prune_dry_run')
 
 class MetadataBuildError(Exception):
     def __init__(self, *args, **kwargs):
@@ -51,6 +66,7 @@ class YumRepo(object):
         self._validate_type(base_dir, 'base_dir', str)
 
         self.id = repoid
+        self._opts = opts
         self.checksum = opts['checksum']
         self.combine = opts['combined_metadata'] if opts['version'] else None
         self.delete = opts['delete']
@@ -65,9 +81,25 @@ class YumRepo(object):
         self.version = time.strftime(opts['version']) if opts['version'] else None
         self.srcpkgs = opts['srcpkgs']
         self.newestonly = opts['newestonly']
+        self.keep_versions = opts['keep_versions']
+        self.keep_snapshots = opts['keep_snapshots']
+        self.keep_snapshots_newer = opts['keep_snapshots_newer']
         self.labels = opts['labels']
-        self._dnfcache_file = util.TemporaryDirectory(prefix='yumsync-', suffix='-dnfcache')
-        self._dnfcache = self._dnfcache_file.name
+        self.upstream_metadata = opts['upstream_metadata']
+        self.cachedir = opts['cachedir']
+        self.metadata_expire = opts['metadata_expire']
+        self.download_workers = opts['download_workers']
+        self.host_connections = opts['host_connections']
+        self.weight = opts['weight']
+        self.deltarpm = opts['deltarpm']
+        self.prune_dry_run = opts['prune_dry_run']
+        self.store = PackageStore(opts['store']) if opts['store'] else None
+        if self.cachedir:
+            # persistent cache, upstream metadata is revalidated between runs
+            self._dnfcache = os.path.join(self.cachedir, self._friendly(self.id))
+        else:
+            self._dnfcache_file = util.TemporaryDirectory(prefix='yumsync-', suffix='-dnfcache')
+            self._dnfcache = self._dnfcache_file.name
 
         # root directory for repo and packages
         self.dir = os.path.join(base_dir, self._friendly(self.id))
@@ -75,6 +107,11 @@ class YumRepo(object):
         # version directory for repo and packages
         self.version_dir = os.path.join(self.dir, self.version) if self.version else None
         self.version_package_dir = os.path.join(self.version_dir, 'packages') if self.version_dir else None
+        # state directory for caches kept between runs, outside of the
+        # published tree as it holds partial downloads and local paths
+        self.state_dir = os.path.join(base_dir, '.yumsync', self._friendly(self.id))
+        # partial downloads, resumed by the next run
+        self.staging_dir = os.path.join(self.state_dir, 'partial')
         # log directory for repo
         self.log_dir = self.version_dir if self.version_dir else self.dir
         # public directroy for repo
@@ -83,14 +120,35 @@ class YumRepo(object):
         # set default callbacks
         self.__repo_callback_obj = None
         self.__yum_callback_obj = None
+        self.__download_slots = None
+        self.__download_governor = None
 
         # set repo placeholders
         self._packages = []
-        self._package_headers = {}
+        self._package_nevras = {}
+        # packages dropped as duplicates or by retention
+        self._retired = set()
         self._comps = None
         self._repomd = None
+        self._upstream_md_dir = None
+        # upstream repomd and group/module data, read once at plan time
+        self._upstream = None
+        self._upstream_repomd = None
+        self._download_failed = False
+        self._ledger = None
+        self._header_index = None
+        self._scanned = {}
+        # set by plan_sync() and finish_sync()
+        self._workers = 1
+        self._metadata_backend = 'thread'
 
     def setup(self):
+        # one dnf base is shared by every step of the sync
+        self._base = self._get_dnf_base()
+        self._sack_filled = False
+        self._upstream = None
+        self._upstream_repomd = None
+        self._scanned = {}
         # set actual repo object
         self.__repo_obj = self._get_repo_obj(self.id, self.local_dir, self.baseurl, self.mirrorlist)
         self.__repo_obj.includepkgs = self.incl_pkgs
@@ -135,7 +193,7 @@ class YumRepo(object):
             opts['includepkgs'] = None
         if 'link_type' in opts and isinstance(opts['link_type'], str):
             opts['link_type'] = opts['link_type'].lower()
-        if 'link_type' not in opts or (opts['link_type'] != 'symlink' and opts['link_type'] != 'hardlink' and opts['link_type'] != 'individual_symlink'):
+        if 'link_type' not in opts or opts['link_type'] not in ('symlink', 'hardlink', 'reflink', 'individual_symlink'):
             opts['link_type'] = 'symlink'
         if 'local_dir' not in opts:
             opts['local_dir'] = None
@@ -151,8 +209,32 @@ class YumRepo(object):
             opts['srcpkgs'] = None
         if 'newestonly' not in opts:
             opts['newestonly'] = None
+        if 'keep_versions' not in opts:
+            opts['keep_versions'] = None
+        if 'keep_snapshots' not in opts:
+            opts['keep_snapshots'] = None
+        if 'keep_snapshots_newer' not in opts:
+            opts['keep_snapshots_newer'] = None
         if 'labels' not in opts:
             opts['labels'] = {}
+        if 'upstream_metadata' not in opts:
+            opts['upstream_metadata'] = None
+        if 'cachedir' not in opts:
+            opts['cachedir'] = None
+        if 'metadata_expire' not in opts:
+            opts['metadata_expire'] = None
+        if 'download_workers' not in opts:
+            opts['download_workers'] = 4
+        if 'host_connections' not in opts:
+            opts['host_connections'] = None
+        if 'store' not in opts:
+            opts['store'] = None
+        if 'weight' not in opts:
+            opts['weight'] = 1
+        if 'deltarpm' not in opts:
+            opts['deltarpm'] = False
+        if 'prune_dry_run' not in opts:
+            opts['prune_dry_run'] = False
         return opts
 
     @classmethod
@@ -187,10 +269,34 @@ class YumRepo(object):
         cls._validate_type(opts['version'], 'version', str, None)
         cls._validate_type(opts['srcpkgs'], 'srcpkgs', bool, None)
         cls._validate_type(opts['newestonly'], 'newestonly', bool, None)
+        cls._validate_type(opts['keep_versions'], 'keep_versions', int, None)
+        if opts['keep_versions'] is not None and opts['keep_versions'] < 1:
+            raise ValueError('keep_versions must be at least 1')
+        cls._validate_type(opts['keep_snapshots'], 'keep_snapshots', int, None)
+        if opts['keep_snapshots'] is not None and opts['keep_snapshots'] < 1:
+            raise ValueError('keep_snapshots must be at least 1')
+        cls._validate_type(opts['keep_snapshots_newer'], 'keep_snapshots_newer', str, int, None)
+        if opts['keep_snapshots_newer'] is not None:
+            util.parse_duration(opts['keep_snapshots_newer'])
         cls._validate_type(opts['labels'], 'labels', dict)
         for label, value in six.iteritems(opts['labels']):
             cls._validate_type(label, 'label_name_{}'.format(label), str)
             cls._validate_type(value, 'label_value_{}'.format(label), str)
+        cls._validate_type(opts['upstream_metadata'], 'upstream_metadata', bool, None)
+        cls._validate_type(opts['cachedir'], 'cachedir', str, None)
+        cls._validate_type(opts['metadata_expire'], 'metadata_expire', str, int, None)
+        cls._validate_type(opts['download_workers'], 'download_workers', int)
+        if opts['download_workers'] < 1:
+            raise ValueError('download_workers must be at least 1')
+        cls._validate_type(opts['host_connections'], 'host_connections', int, None)
+        if opts['host_connections'] is not None and opts['host_connections'] < 1:
+            raise ValueError('host_connections must be at least 1')
+        cls._validate_type(opts['store'], 'store', str, None)
+        cls._validate_type(opts['weight'], 'weight', int, float)
+        if opts['weight'] <= 0:
+            raise ValueError('weight must be positive')
+        cls._validate_type(opts['deltarpm'], 'deltarpm', bool)
+        cls._validate_type(opts['prune_dry_run'], 'prune_dry_run', bool)
 
     @staticmethod
     def _sanitize(text):
@@ -200,16 +306,26 @@ class YumRepo(object):
     def _friendly(cls, text):
         return cls._sanitize(text).replace('/', '_')
 
-    def _get_repo_obj(self, repoid, localdir=None, baseurl=None, mirrorlist=None):
+    def _get_dnf_base(self):
         base = dnf.Base()
         base.conf.cachedir = self._dnfcache
         base.conf.debuglevel = 0
         base.conf.errorlevel = 3
-        repo = dnf.repo.Repo(repoid.replace('/', '_'), base.conf)
+        return base
+
+    def _get_repo_obj(self, repoid, localdir=None, baseurl=None, mirrorlist=None):
+        repo = dnf.repo.Repo(repoid.replace('/', '_'), self._base.conf)
         repo.baseurl = None
         repo.metalink = None
         repo.mirrorlist = None
         repo.module_hotfixes = True
+        # prestodelta is only loaded when deltas are used
+        repo.deltarpm = self.deltarpm
+        if self.metadata_expire is not None:
+            repo.metadata_expire = self.metadata_expire
+        elif self.cachedir:
+            # always check upstream, unchanged metadata is kept as is
+            repo.metadata_expire = 0
 
         if baseurl is not None:
             repo.baseurl = baseurl
@@ -226,6 +342,16 @@ class YumRepo(object):
     def set_yum_callback(self, callback):
         self.__yum_callback_obj = callback
 
+    def set_download_slots(self, slots):
+        """ Share a semaphore bounding connections across all repositories. """
+        self.__download_slots = slots
+
+    def set_download_governor(self, governor):
+        """ Share a governor limiting the download rate of all repositories. """
+        self.__download_governor = governor
+        if governor:
+            governor.set_weight(self.id, self.weight)
+
     def _set_path(self, path):
         repo = copy.copy(self.__repo_obj)
         try:
@@ -254,7 +380,7 @@ class YumRepo(object):
         if self.version_dir:
             if os.path.islink(self.version_package_dir) or os.path.isfile(self.version_package_dir):
                 os.unlink(self.version_package_dir)
-            elif os.path.isdir(self.version_package_dir):
+            elif os.path.isdir(self.version_package_dir) and self.link_type == 'symlink':
                 shutil.rmtree(self.version_package_dir)
             if self.link_type == 'symlink':
                 util.symlink(self.version_package_dir, os.path.relpath(self.package_dir, self.version_dir))
@@ -266,14 +392,15 @@ class YumRepo(object):
                 elif isinstance(self.local_dir, str):
                     dirs = [self.local_dir]
                     single = True
+                # the snapshot is kept between runs of the same version, only apply the difference
+                links = {}
                 for idx, _dir in enumerate(dirs):
-                    pkg_dir = self.version_package_dir
-                    if not single:
-                        pkg_dir = os.path.join(self.version_package_dir, "repo_{}".format(idx))
-                        util.make_dir(os.path.join(pkg_dir))
-                    for _file in self._find_rpms(_dir):
-                        util.symlink(os.path.join(pkg_dir, _file), os.path.join(_dir, _file))
-            else: # hardlink
+                    pkg_dir = '' if single else "repo_{}".format(idx)
+                    for _file, _ in self._find_rpms(_dir):
+                        links[os.path.join(pkg_dir, _file)] = os.path.join(_dir, _file)
+                created, removed = util.symlink_tree(self.version_package_dir, links)
+                logging.debug('{}: {:d} package links created, {:d} removed'.format(self.id, len(created), len(removed)))
+            else: # hardlink or reflink
                 util.make_dir(self.version_package_dir)
 
     def download_gpgkey(self):
@@ -301,52 +428,97 @@ class YumRepo(object):
             return gpgkey_paths
         return None
 
-    def prepare_packages(self):
-        self.download_packages()
-        self.prune_packages()
-        self.version_packages()
+    def _validate_packages(self, directory, packages, stats=None):
+        """ Return the (package, NEVRA) of the valid RPMs among packages.
 
-    def download_packages(self):
-        if self.local_dir:
-            self._download_local_packages()
-        else:
-            self._download_remote_packages()
-
-    def _validate_packages(self, directory, packages):
-        if hasattr(rpm, "RPMVSF_MASK_NOSIGNATURES"):
-            no_signature_check_mask = rpm.RPMVSF_MASK_NOSIGNATURES
-        else:
-            no_signature_check_mask = rpm.RPMVSF_NODSAHEADER | rpm.RPMVSF_NORSAHEADER | rpm.RPMVSF_NODSA | rpm.RPMVSF_NORSA
-        ts = rpm.TransactionSet("/", no_signature_check_mask)
+        stats optionally maps packages to their stat, saving a stat call
+        when the header index is looked up. Packages missing from the index
+        are read in parallel, by worker processes with the process metadata
+        backend.
+        """
+        stats = stats or {}
         if isinstance(packages, str):
             self._callback('pkg_exists', packages)
-            package, hdr = self._validate_package(ts, directory, packages)
-            if hdr:
-                return package, hdr
-            return package, None
+            return packages, self._read_nevras(directory, [packages], stats)[0]
         elif isinstance(packages, list):
-            valid = []
-            for pkg in packages:
-                package, hdr = self._validate_package(ts, directory, pkg)
-                if hdr:
-                    valid.append((package, hdr))
-                    self._callback('pkg_exists', pkg)
-            return valid
+            nevras = [None] * len(packages)
+            batch = []
+            # progress is reported as packages are read, in any order
+            for idx, nevra in self._iter_nevras(directory, packages, stats):
+                nevras[idx] = nevra
+                if nevra:
+                    batch.append(packages[idx])
+                    if len(batch) >= PROGRESS_BATCH:
+                        self._callback('pkgs_exist', batch)
+                        batch = []
+            if batch:
+                self._callback('pkgs_exist', batch)
+            return [(pkg, nevra) for pkg, nevra in zip(packages, nevras) if nevra]
         else:
             return None
 
-    @staticmethod
-    def _validate_package(ts, directory, package):
-        try:
-            pkg_path = os.path.join(directory, package)
-            with open(pkg_path, 'rb') as pkg:
-                return package, ts.hdrFromFdno(pkg)
-        except:
-            return package, None
+    def _read_nevras(self, directory, packages, stats):
+        """ Return the NEVRA of each package, None for invalid ones. """
+        nevras = [None] * len(packages)
+        for idx, nevra in self._iter_nevras(directory, packages, stats):
+            nevras[idx] = nevra
+        return nevras
+
+    def _iter_nevras(self, directory, packages, stats):
+        """ Yield (index, NEVRA) of packages as they are read, None for invalid
+        ones. Indexed packages come first, then chunks of the others as soon as
+        a worker is done with them.
+        """
+        index = self._header_index
+        misses = []
+        for idx, pkg in enumerate(packages):
+            path = os.path.join(directory, pkg)
+            try:
+                st = stats.get(pkg) or os.stat(path)
+            except OSError:
+                yield idx, None
+                continue
+            entry = index.get(path, st) if index is not None else None
+            if entry is not None:
+                yield idx, entry['nevra'] if entry['valid'] else None
+            else:
+                misses.append((idx, path, st))
+        if not misses:
+            return
+        workers = self._workers
+        if workers > 1 and len(misses) > 1:
+            if self._metadata_backend == 'process':
+                executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+            chunksize = max(1, min(VALIDATE_CHUNK, len(misses) // workers))
+            chunks = [misses[i:i + chunksize] for i in range(0, len(misses), chunksize)]
+            with executor:
+                futures = dict((executor.submit(headers.read_nevras, [path for _, path, _ in chunk]), chunk)
+                               for chunk in chunks)
+                for future in as_completed(futures):
+                    for item in self._index_nevras(futures[future], future.result()):
+                        yield item
+        else:
+            for miss in misses:
+                for item in self._index_nevras([miss], [headers.read_nevra(miss[1])]):
+                    yield item
+
+    def _index_nevras(self, misses, nevras):
+        """ Record read NEVRAs in the header index, yielding (index, NEVRA). """
+        index = self._header_index
+        for (idx, path, st), nevra in zip(misses, nevras):
+            if index is not None:
+                index.put(path, st, {'valid': nevra is not None, 'nevra': nevra})
+            yield idx, nevra
 
     def _find_rpms(self, local_dir):
-        matches = []
-        progress_counter = 0
+        """ Return the sorted (relative path, stat) of the RPMs to use from local_dir.
+
+        The scan is done once per sync and shared by every step needing it.
+        """
+        if local_dir in self._scanned:
+            return self._scanned[local_dir]
         include_globs = []
         exclude_globs = []
 
@@ -361,29 +533,9 @@ class YumRepo(object):
             elif isinstance(self.__repo_obj.excludepkgs, str):
                 exclude_globs = [self.__repo_obj.excludepkgs]
 
-        for root, dirnames, filenames in os.walk(local_dir, topdown=False, followlinks=True):
-            for filename in filenames:
-                if not filename.endswith('.rpm'):
-                    continue
-                skip = False
-                keep = True
-                for glob in exclude_globs:
-                    if fnmatch(filename, glob):
-                        skip = True
-                        break
-                if skip:
-                    continue
-                for glob in include_globs:
-                    if fnmatch(filename, glob):
-                        keep = True
-                        break
-                    else:
-                        keep = False
-                if not keep:
-                    continue
-                bisect.insort(matches, os.path.relpath(os.path.join(root, filename), local_dir))
-
-        return matches
+        matcher = scan.GlobMatcher(list(include_globs), list(exclude_globs))
+        self._scanned[local_dir] = scan.find_rpms(local_dir, matcher)
+        return self._scanned[local_dir]
 
     def _download_local_packages(self):
         try:
@@ -391,22 +543,25 @@ class YumRepo(object):
             nb_packages = 0
             self._callback('repo_init', nb_packages, True)
             if isinstance(self.local_dir, str):
-                files = self._find_rpms(self.local_dir)
-                packages = {(None, self.local_dir): self._validate_packages(self.local_dir, files)}
+                found = self._find_rpms(self.local_dir)
+                files = [_file for _file, _ in found]
+                packages = {(None, self.local_dir): self._validate_packages(self.local_dir, files, dict(found))}
                 nb_packages += len(packages[(None, self.local_dir)])
             elif isinstance(self.local_dir, list):
                 packages = {}
                 files = {}
                 for idx, local_dir in enumerate(self.local_dir):
-                    files[(idx, local_dir)] = self._find_rpms(local_dir)
+                    files[(idx, local_dir)] = [_file for _file, _ in self._find_rpms(local_dir)]
                     nb_packages += len(files[(idx,local_dir)])
                     self._callback('repo_init', nb_packages, True)
                 for local_dir_idx, rpm_files in six.iteritems(files):
-                    packages[local_dir_idx] = self._validate_packages(local_dir_idx[1], rpm_files)
+                    packages[local_dir_idx] = self._validate_packages(local_dir_idx[1], rpm_files,
+                                                                      dict(self._find_rpms(local_dir_idx[1])))
             self._callback('repo_init', nb_packages, True)
 
+            sources = {}
             for _dir, _files in six.iteritems(packages):
-                for _file, _hdr in _files:
+                for _file, _nevra in _files:
                     if _dir[0] is not None and isinstance(_dir[0], int):
                         package_dir = os.path.join(self.package_dir, "repo_{}".format(_dir[0]))
                         file_path = os.path.join("repo_{}".format(_dir[0]), _file)
@@ -414,12 +569,20 @@ class YumRepo(object):
                         package_dir = self.package_dir
                         file_path = _file
                     self._packages.append(file_path)
-                    self._package_headers[file_path] = _hdr
-                    if self.link_type == 'hardlink':
-                        status = util.hardlink(os.path.join(_dir[1], _file), os.path.join(package_dir, _file))
-                        if status:
-                            size = os.path.getsize(os.path.join(_dir[1], _file))
-                            self._callback('link_local_pkg', _file, size)
+                    self._package_nevras[file_path] = _nevra
+                    sources[file_path] = (_dir, _file, package_dir)
+            self.deduplicate_rpm()
+
+            if self.link_type in ('hardlink', 'reflink'):
+                link_many = util.reflink_many if self.link_type == 'reflink' else util.hardlink_many
+                groups = {}
+                for file_path in self._packages:
+                    _dir, _file, package_dir = sources[file_path]
+                    groups.setdefault((_dir[1], package_dir), []).append(_file)
+                for (source_dir, package_dir), _files in six.iteritems(groups):
+                    stats = dict(self._find_rpms(source_dir))
+                    for _file in link_many(source_dir, package_dir, _files, self._workers):
+                        self._callback('link_local_pkg', _file, stats[_file].st_size)
 
             self._callback('repo_complete')
         except (KeyboardInterrupt, SystemExit):
@@ -428,56 +591,332 @@ class YumRepo(object):
             self._callback('repo_error', str(e))
             raise PackageDownloadError(str(e))
 
-    def _download_remote_packages(self):
+    def _fill_sack(self):
+        """ Load the upstream metadata into the shared dnf base, once. """
+        if not self._sack_filled:
+            self._remote_repo = self._set_path(self.package_dir)
+            self._base.repos.add(self._remote_repo)
+            self._base.fill_sack()
+            self._sack_filled = True
+        return self._base
+
+    def _upstream_repodata(self):
+        """ Directory holding the upstream repodata loaded by dnf. """
+        self._fill_sack()
+        # <cachedir>/<repo>/repodata/<checksum>-primary.xml.gz
+        return os.path.dirname(self._remote_repo.get_metadata_path('primary'))
+
+    def _upstream_state(self):
+        """ Describe the upstream repomd.xml, read when first needed.
+
+        finish_sync() gets it from the plan, so the state saved at the end of
+        a sync is that of the metadata its packages were selected from.
+        """
+        if self._upstream is None:
+            repomd_path = os.path.join(self._upstream_repodata(), 'repomd.xml')
+            with open(repomd_path, 'rb') as f:
+                repomd_checksum = hashlib.sha256(f.read()).hexdigest()
+            self._upstream = {
+                'repomd_revision': createrepo.Repomd(repomd_path).revision,
+                'repomd_checksum': repomd_checksum,
+            }
+        return self._upstream
+
+    def _sync_state(self):
+        """ Describe the upstream metadata and local packages of this repo.
+
+        Two syncs with the same state would produce the same result, which
+        lets an unchanged repository skip everything but its links.
+        """
+        packages = hashlib.sha256()
+        for entry in sorted(os.listdir(self.package_dir)):
+            st = os.stat(os.path.join(self.package_dir, entry))
+            packages.update('{} {} {}\n'.format(entry, st.st_size, st.st_mtime).encode('utf-8'))
+        state = {
+            'config': self._config_fingerprint(),
+            'packages': packages.hexdigest(),
+        }
+        state.update(self._upstream_state())
+        return state
+
+    def _config_fingerprint(self):
+        """ Hash every option affecting the result of a sync, with the effective version. """
+        config = dict((k, v) for k, v in self._opts.items() if k not in RUNTIME_OPTS)
+        config['version'] = self.version
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _is_unchanged(self):
+        if self.local_dir:
+            return False
+        if not os.path.exists(os.path.join(self.log_dir, 'repodata')) or not os.path.isdir(self.package_dir):
+            return False
+        last_state = util.load_json(os.path.join(self.state_dir, 'sync.json'))
+        return last_state is not None and last_state == self._sync_state()
+
+    def _save_sync_state(self):
+        state_path = os.path.join(self.state_dir, 'sync.json')
+        if self.local_dir:
+            return
+        if self._download_failed:
+            # make sure the next run retries
+            if os.path.exists(state_path):
+                os.unlink(state_path)
+            return
+        util.save_json(state_path, self._sync_state())
+
+    @contextmanager
+    def _cache_lock(self):
+        """ Serialize processes sharing the persistent dnf cache of this repo. """
+        if self.cachedir:
+            with util.lock(os.path.join(self._dnfcache, '.lock')):
+                yield
+        else:
+            yield
+
+    @contextmanager
+    def hold_lock(self):
+        """ Lock the repository and its dnf cache for the duration of the context.
+
+        yumsync.sync() holds it from plan_sync() to the end of finish_sync(),
+        which run in other processes and then take no lock of their own, so
+        no other sync or collection of the repository starts in between.
+        """
+        self._migrate_state_dir()
+        with util.lock(os.path.join(self.state_dir, 'lock')):
+            with self._cache_lock():
+                self._lock_held = True
+                try:
+                    yield
+                finally:
+                    self._lock_held = False
+
+    def _migrate_state_dir(self):
+        """ Move the state of older releases out of the repository directory. """
+        legacy = os.path.join(self.dir, '.yumsync')
+        if os.path.isdir(legacy) and not os.path.lexists(self.state_dir):
+            util.make_dir(os.path.dirname(self.state_dir))
+            try:
+                os.rename(legacy, self.state_dir)
+            except OSError as e:
+                logging.warning('{}: unable to move {} to {} ({})'.format(self.id, legacy, self.state_dir, e))
+
+    @contextmanager
+    def _repo_lock(self):
+        """ Lock the repository, unless hold_lock() already does. """
+        if getattr(self, '_lock_held', False):
+            yield
+        else:
+            with self.hold_lock():
+                yield
+
+    def _plan_remote_packages(self):
+        """ Select the packages of a remote repo and return those to download. """
         self._callback('repo_init', 0, True)
-        yb = dnf.Base()
-        yb.conf.cachedir = self._dnfcache
-        yb.conf.debuglevel = 0
-        yb.conf.errorlevel = 3
-        repo = self._set_path(self.package_dir)
-        yb.repos.add(repo)
-        yb.fill_sack()
+        yb = self._fill_sack()
+        repo = self._remote_repo
+        if self.upstream_metadata:
+            self._upstream_md_dir = os.path.dirname(self._upstream_repodata())
         p_query = yb.sack.query().available()
         if self.newestonly:
             p_query = p_query.latest()
+        elif self.keep_versions:
+            p_query = p_query.latest(self.keep_versions)
         packages = list(p_query)
+        targets = []
         # Inform about number of packages total in the repo.
         # Check if the packages are already downloaded. This is probably a bit
         # expensive, but the alternative is simply not knowing, which is
         # horrible for progress indication.
         if packages:
             self._callback('repo_init', len(packages), True)
-            for po in packages:
-                local = po.localPkg()
-                self._packages.append(os.path.basename(local))
-                if os.path.exists(local):
-                    self._callback('pkg_exists', os.path.basename(local))
-            try:
-                yb.download_packages(packages, progress=progress.DownloadProgress(self._callback))
-            except (KeyboardInterrupt, SystemExit):
-                return
-            except dnf.exceptions.DownloadError as e:
-                self._callback('repo_error', str(e))
-            except Exception as e:
-                self._callback('repo_error', str(e))
-                raise PackageDownloadError(str(e))
+            self._settings = download.TransferSettings.from_repo(repo)
+            repo_mirrors = self._mirrors(repo)
+            # Existing files are only trusted when the ledger says they were
+            # verified with the same stats, anything else is hashed again.
+            with self._open_ledger():
+                unverified = []
+                for po in packages:
+                    local = po.localPkg()
+                    self._packages.append(os.path.basename(local))
+                    target = self._download_target(po, repo_mirrors)
+                    if os.path.exists(local):
+                        if self._ledger.get(local, os.stat(local)) == [target.checksum_type, target.checksum]:
+                            if self.store:
+                                self._record_verified(target)
+                            self._callback('pkg_exists', target.name)
+                        else:
+                            unverified.append(target)
+                    elif self.store and self.store.link_out(target.checksum_type, target.checksum, local):
+                        self._record_verified(target)
+                        self._callback('link_local_pkg', target.name, target.size)
+                    else:
+                        targets.append(target)
+                targets.extend(self._verify_existing(unverified))
+                self._ledger.prune()
+            if self.deltarpm and targets:
+                self._plan_deltas(targets, dict((os.path.basename(po.localPkg()), po) for po in packages))
+            if self.mirrorlist and len(repo_mirrors) > 1 and targets:
+                self._rank_mirrors(repo_mirrors, targets)
+        return targets
+
+    def _plan_deltas(self, targets, packages):
+        """ Download deltas for packages with an older version on disk. """
+        if not delta.available():
+            logging.warning('{}: {} not found, downloading full packages'.format(self.id, delta.APPLYDELTARPM))
+            return
+        local = delta.LocalPackages(self._package_dirs())
+        for target in targets:
+            target.delta = local.find_delta(packages[target.name],
+                                            os.path.join(self.staging_dir, '{}.drpm'.format(target.checksum)))
+
+    def _package_dirs(self):
+        """ Return the packages directory and that of the previous snapshot, if
+        hardlinked. Older snapshots only hold packages pruned since, which are
+        rarely the base of a delta, and scanning them all grows with history.
+        """
+        dirs = [self.package_dir] if os.path.isdir(self.package_dir) else []
+        latest = os.path.join(self.dir, 'latest')
+        if self.version and os.path.islink(latest):
+            previous = os.path.normpath(os.path.join(self.dir, os.readlink(latest)))
+            previous_packages = os.path.join(previous, 'packages')
+            if (previous != os.path.normpath(self.version_dir) and os.path.isdir(previous_packages)
+                    and not os.path.islink(previous_packages)):
+                dirs.append(previous_packages)
+        return dirs
+
+    def _rank_mirrors(self, repo_mirrors, targets):
+        """ Route downloads to the mirrors known or probed to be fastest. """
+        history = mirrors.MirrorHistory(os.path.join(self.state_dir, 'mirrors.json'))
+        downloader = self._downloader()
+        try:
+            mirrors.probe(downloader, repo_mirrors, targets[0].location, history)
+        finally:
+            downloader.close()
+        history.save()
+        ranked = history.rank(repo_mirrors)
+        width = min(mirrors.SPREAD, len(history.healthy(repo_mirrors)))
+        for idx, target in enumerate(targets):
+            if target.mirrors is repo_mirrors:
+                target.mirrors = mirrors.spread(ranked, idx, width)
+
+    def _downloads_complete(self, targets, failed):
+        """ Record downloaded packages once every target has been attempted. """
+        failed_names = set(target.name for target in failed)
+        with self._open_ledger():
+            for target in targets:
+                if target.name not in failed_names:
+                    self._record_verified(target)
+        if any(target.samples for target in targets):
+            history = mirrors.MirrorHistory(os.path.join(self.state_dir, 'mirrors.json'))
+            for target in targets:
+                for sample in target.samples:
+                    history.record(*sample)
+            history.save()
+        if failed:
+            self._download_failed = True
+            self._callback('repo_error', '{:d} packages failed to download'.format(len(failed)))
+        self._clean_staging(failed)
         self._callback('repo_complete')
 
-    def deduplicate_rpm(self):
-        nevra_index = set()
-        print(len(self._packages))
-        for pkg_path, pkg_header in six.iteritems(self._package_headers):
-            if pkg_header is not None:
-                nevra = "{}-{}-{}-{}.{}".format(
-                    pkg_header['name'],
-                    pkg_header['epoch'],
-                    pkg_header['version'],
-                    pkg_header['release'],
-                    pkg_header['arch'])
-                if nevra in nevra_index:
-                    self._packages.remove(pkg_path)
+    @contextmanager
+    def _open_ledger(self):
+        self._ledger = VerificationLedger(os.path.join(self.state_dir, 'verified.sqlite'))
+        try:
+            yield self._ledger
+        finally:
+            self._ledger.close()
+            self._ledger = None
+
+    @contextmanager
+    def _open_header_index(self):
+        self._header_index = HeaderIndex(os.path.join(self.state_dir, 'headers.sqlite'))
+        try:
+            yield self._header_index
+        finally:
+            self._header_index.prune()
+            self._header_index.close()
+            self._header_index = None
+
+    def _verify_existing(self, targets):
+        """ Hash existing packages in parallel, returning those to download again. """
+        invalid = []
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = dict((executor.submit(target.verify, target.dest), target) for target in targets)
+            for future in as_completed(futures):
+                target = futures[future]
+                if future.exception() is None:
+                    self._record_verified(target)
+                    self._callback('pkg_exists', target.name)
                 else:
-                    nevra_index.add(nevra)
+                    logging.info('{}: {}, downloading again'.format(target.name, future.exception()))
+                    invalid.append(target)
+        return invalid
+
+    def _record_verified(self, target):
+        # the store may replace dest by its own copy, so stat it afterwards
+        if self.store:
+            self.store.add(target.checksum_type, target.checksum, target.dest)
+        self._ledger.put(target.dest, os.stat(target.dest), [target.checksum_type, target.checksum])
+
+    @staticmethod
+    def _mirrors(repo):
+        """ Return the mirrors of the metalink or mirrorlist dnf cached for
+        repo, else its baseurls.
+        """
+        repo_cache = os.path.dirname(os.path.dirname(repo.get_metadata_path('primary')))
+        for name in ('metalink.xml', 'mirrorlist'):
+            found = mirrors.read_mirrorlist(os.path.join(repo_cache, name))
+            if found:
+                return found
+        return list(repo.baseurl) if repo.baseurl else []
+
+    def _download_target(self, po, mirrors):
+        checksum_type, checksum = po.chksum
+        checksum = binascii.hexlify(checksum).decode('ascii')
+        return download.DownloadTarget(
+            os.path.basename(po.localPkg()),
+            po.location,
+            [po.baseurl] if po.baseurl else mirrors,
+            po.localPkg(),
+            size=po.downloadsize,
+            checksum_type=hawkey.chksum_name(checksum_type),
+            checksum=checksum,
+            partial=os.path.join(self.staging_dir, '{}.part'.format(checksum)),
+            settings=getattr(self, '_settings', None))
+
+    def _downloader(self):
+        return download.Downloader(workers=self.download_workers,
+                                   host_connections=self.host_connections,
+                                   slots=self.__download_slots,
+                                   governor=self.__download_governor,
+                                   key=self.id,
+                                   settings=getattr(self, '_settings', None))
+
+    def _clean_staging(self, failed):
+        """ Drop partial downloads, except those of failed packages to resume. """
+        if not os.path.isdir(self.staging_dir):
+            return
+        keep = set('{}.part'.format(target.checksum) for target in failed)
+        for _file in os.listdir(self.staging_dir):
+            if _file not in keep:
+                os.unlink(os.path.join(self.staging_dir, _file))
+
+    def _download_done(self, target, error):
+        if error is None:
+            self._callback('download_end', target.name, target.size)
+
+    def deduplicate_rpm(self):
+        """ Drop packages whose NEVRA is already in the repo, and apply retention.
+
+        The first package of a NEVRA wins. With newestonly or keep_versions,
+        only the newest versions of each name.arch are kept.
+        """
+        index = NevraIndex()
+        for pkg_path in self._packages:
+            index.add(pkg_path, self._package_nevras.get(pkg_path))
+        retained = index.retain(1 if self.newestonly else self.keep_versions)
+        self._retired.update(set(self._packages) - set(retained))
+        self._packages = retained
 
     def prune_packages(self):
         # exit if we don't have packages
@@ -491,23 +930,103 @@ class YumRepo(object):
 
         if self.delete:
             if not self.version or (self.link_type != 'symlink' and self.link_type != 'individual_symlink'):
-                for _file in os.listdir(self.package_dir):
-                    if _file not in self._packages:
-                        os.unlink(os.path.join(self.package_dir, _file))
-                        self._callback('delete_pkg', _file)
+                self._delete_packages(self._plan_prune())
         else:
-            packages_to_validate = sorted(list(set(os.listdir(self.package_dir)) - set(self._packages)))
-            self._packages.extend(self._validate_packages(self.package_dir, packages_to_validate))
+            # known packages are not read again, see _validate_packages()
+            leftovers = [(name, st) for name, _, st in self._plan_prune()
+                         if st is not None and name not in self._retired]
+            for package, nevra in self._validate_packages(self.package_dir, [name for name, _ in leftovers],
+                                                          dict(leftovers)):
+                self._packages.append(package)
+                self._package_nevras[package] = nevra
+
+    def _plan_prune(self):
+        """ Return the files of the packages directory not part of the repo.
+
+        Each file comes with its lstat and its stat, None for a dangling
+        symlink, from a single scan of the directory.
+        """
+        wanted = set(self._packages)
+        leftovers = []
+        for entry in os.scandir(self.package_dir):
+            if entry.name in wanted:
+                continue
+            try:
+                if entry.is_dir():
+                    continue
+                lst = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                st = None
+            leftovers.append((entry.name, lst, st))
+        leftovers.sort()
+        return leftovers
+
+    def _delete_packages(self, leftovers):
+        """ Unlink leftovers in batches, reporting the space reclaimed. """
+        # hardlinks still used by snapshots or the store free nothing
+        reclaimable = sum(lst.st_size for _, lst, _ in leftovers
+                          if stat.S_ISREG(lst.st_mode) and lst.st_nlink == 1)
+        if self.prune_dry_run or not leftovers:
+            self._callback('prune_summary', len(leftovers), reclaimable, self.prune_dry_run)
+            return
+        names = [name for name, _, _ in leftovers]
+        dir_fd = os.open(self.package_dir, os.O_RDONLY | os.O_DIRECTORY)
+
+        def unlink_batch(batch):
+            for name in batch:
+                try:
+                    os.unlink(name, dir_fd=dir_fd)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        try:
+            batches = [names[i:i + PRUNE_BATCH] for i in range(0, len(names), PRUNE_BATCH)]
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for batch, _ in zip(batches, executor.map(unlink_batch, batches)):
+                    for name in batch:
+                        self._callback('delete_pkg', name)
+        finally:
+            os.close(dir_fd)
+        self._callback('prune_summary', len(leftovers), reclaimable, False)
 
     def version_packages(self):
-        # exit if we don't have packages
-        if not self._packages or len(self._packages) == 0:
+        if self.version and self.link_type in ('hardlink', 'reflink'):
+            # the snapshot is kept between runs of the same version, only apply the difference
+            removed = util.prune_tree(self.version_package_dir, self._packages or [])
+            logging.debug('{}: {:d} stale package links removed'.format(self.id, len(removed)))
+            # exit if we don't have packages
+            if not self._packages:
+                return
+            link_many = util.reflink_many if self.link_type == 'reflink' else util.hardlink_many
+            link_many(self.package_dir, self.version_package_dir, self._packages, self._workers)
+
+    def collect_snapshots(self, workers=1):
+        """ Delete the snapshots expired by keep_snapshots and keep_snapshots_newer,
+        and the packages no remaining snapshot references. The latest, stable and
+        labelled snapshots are always kept.
+        """
+        if not self.version or (self.keep_snapshots is None and self.keep_snapshots_newer is None):
             return
-        if self.version and self.link_type == 'hardlink':
-            for pkg in self._packages:
-                source_file = os.path.join(self.package_dir, pkg)
-                target_file = os.path.join(self.version_package_dir, pkg)
-                util.hardlink(source_file, target_file)
+        newer_than = None
+        if self.keep_snapshots_newer is not None:
+            newer_than = util.parse_duration(self.keep_snapshots_newer)
+        pinned = [self.stable] + list(self.labels.values())
+        # a sync of the repository could download packages no snapshot references
+        # yet, so reachability is only decided, and acted upon, under its lock
+        with self._repo_lock():
+            collection = snapshots.plan(self.dir, self.package_dir, keep=self.keep_snapshots,
+                                        newer_than=newer_than, pinned=pinned)
+            for snapshot in collection.snapshots:
+                self._callback('delete_snapshot', snapshot.version)
+            if not self.prune_dry_run:
+                snapshots.collect(self.dir, self.package_dir, collection, workers)
+        self._callback('gc_summary', len(collection.snapshots), len(collection.packages),
+                       collection.reclaimable, self.prune_dry_run)
 
     def get_md_data(self):
         if self.local_dir:
@@ -522,19 +1041,21 @@ class YumRepo(object):
                 repo_dirs = [ self.local_dir ]
             elif isinstance(self.local_dir, list):
                 repo_dirs = [ l for l in self.local_dir ]
-            for repo_dir in repo_dirs:
+            # the metadata of every directory is loaded at once, by the shared dnf base
+            yb = self._base
+            md_repos = []
+            for idx, repo_dir in enumerate(repo_dirs):
                 if not os.path.exists(os.path.join(repo_dir, 'repodata')):
                     continue
-                yb = dnf.Base()
-                yb.conf.cachedir = self._dnfcache
-                yb.conf.debuglevel = 0
-                yb.conf.errorlevel = 3
-                repo = dnf.repo.Repo("yumsync_temp_md_repo", dnf.Base().conf)
+                repo = dnf.repo.Repo("yumsync_temp_md_repo_{}".format(idx), yb.conf)
                 repo.metalink = None
                 repo.mirrorlist = None
                 repo.baseurl = "file://{}".format(repo_dir)
                 yb.repos.add(repo)
+                md_repos.append(repo)
+            if md_repos:
                 yb.fill_sack()
+            for repo in md_repos:
                 repomds.append({
                     ("modules", "modules.yaml"): repo.get_metadata_content('modules'),
                     ("group", "comps.xml"): repo.get_metadata_content('group_gz'),
@@ -546,10 +1067,7 @@ class YumRepo(object):
                 if self._repomd.get(("group", "comps.xml"), "") == "":
                     self._repomd[("group", "comps.xml")] = repomd.get(("group", "comps.xml"), "")
         else:
-            self._repomd = {
-                ("modules", "modules.yaml"): self.__repo_obj.get_metadata_content('modules'),
-                ("group", "comps.xml"): self.__repo_obj.get_metadata_content('group_gz'),
-            }
+            self._repomd = dict(self._read_upstream_repomd())
 
         if self._repomd:
             # Filter out empty metadata
@@ -561,6 +1079,28 @@ class YumRepo(object):
         else:
             self._callback('repo_group_data', 'unavailable')
 
+    def _read_upstream_repomd(self):
+        """ Return the upstream module and group data, read when first needed. """
+        if self._upstream_repomd is None:
+            self._fill_sack()
+            self._upstream_repomd = {
+                ("modules", "modules.yaml"): self.__repo_obj.get_metadata_content('modules'),
+                ("group", "comps.xml"): self.__repo_obj.get_metadata_content('group_gz'),
+            }
+        return self._upstream_repomd
+
+    def _load_upstream_metadata(self, filenames):
+        """ Load the upstream records of the given package filenames only. """
+        if not self._upstream_md_dir:
+            return None
+        try:
+            md = createrepo.Metadata(createrepo.HT_KEY_FILENAME, False, list(filenames))
+            md.locate_and_load_xml(self._upstream_md_dir)
+        except Exception:
+            logging.exception("Unable to load upstream metadata from {}".format(self._upstream_md_dir))
+            return None
+        return md
+
     def build_metadata(self):
         staging = tempfile.mkdtemp(prefix='yumsync-', suffix='-metadata')
 
@@ -610,7 +1150,6 @@ class YumRepo(object):
         # Process all packages in // if possible
         self.metadata_progress = 0
         self.total_pkgs = len(pkg_list)
-        metadata_mutex = Lock()
 
         def collect_result(future):
             self.metadata_progress += 1
@@ -621,36 +1160,105 @@ class YumRepo(object):
             pkg.location_href = href
             return pkg
 
+        # Packages described by the upstream metadata are taken from it as-is,
+        # without reading the RPMs, when the ledger verified the local file
+        # against the checksum of the upstream record.
+        upstream_md = self._load_upstream_metadata(os.path.basename(href) for _, href in pkg_list)
+        ledger = VerificationLedger(os.path.join(self.state_dir, 'verified.sqlite')) \
+            if upstream_md is not None else None
+
+        # Reuse packages parsed by a previous run when the file is unchanged,
+        # only new or modified RPMs get read and checksummed.
+        cache = PackageCache(os.path.join(self.state_dir, 'packages.sqlite'))
+        pkgs = [None] * len(pkg_list)
+        to_parse = []
+        for idx, (filename, href) in enumerate(pkg_list):
+            try:
+                path = os.path.realpath(filename)
+                st = os.stat(path)
+            except OSError:
+                logging.exception("Unable to stat package {}".format(filename))
+                continue
+            if upstream_md is not None:
+                pkg = upstream_md.get(os.path.basename(href))
+                if (pkg is not None and pkg.size_package == st.st_size and
+                        ledger.get(filename, st) == [pkg.checksum_type, pkg.pkgId]):
+                    pkg.location_href = href
+                    pkg.location_base = None
+                    pkgs[idx] = pkg
+                    collect_result(None)
+                    continue
+            record = cache.get(path, st)
+            if record is not None:
+                pkgs[idx] = records.package_from_record(record, href)
+                collect_result(None)
+            else:
+                to_parse.append((idx, path, st, href))
+
         try:
-            from concurrent.futures import ThreadPoolExecutor
+            from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
             parallelize = True
         except:
             parallelize = False
 
-        if parallelize:
+        if parallelize and self._metadata_backend == 'process':
+            # Headers are parsed and checksummed in worker processes, which
+            # only send back compact package records.
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                futures = []
+                for idx, path, st, href in to_parse:
+                    future = executor.submit(records.parse_package, path)
+                    future.add_done_callback(collect_result)
+                    futures.append((idx, path, st, href, future))
+                for idx, path, st, href, future in futures:
+                    try:
+                        record = future.result()
+                    except Exception as exc:
+                        logging.exception("Process generated an exception")
+                    else:
+                        pkgs[idx] = records.package_from_record(record, href)
+                        cache.put(path, st, record)
+        elif parallelize:
             with ThreadPoolExecutor(max_workers=self._workers) as executor:
                 futures = []
-                for filename in pkg_list:
-                    future = executor.submit(process_pkg, filename[0], filename[1])
+                for idx, path, st, href in to_parse:
+                    future = executor.submit(process_pkg, path, href)
                     future.add_done_callback(collect_result)
-                    futures.append(future)
-                for future in futures:
+                    futures.append((idx, path, st, future))
+                for idx, path, st, future in futures:
                     try:
-                        pkg = future.result(10)
+                        pkgs[idx] = future.result()
                     except Exception as exc:
                         logging.exception("Thread generated an exception")
                     else:
-                        pri_xml.add_pkg(pkg)
-                        fil_xml.add_pkg(pkg)
-                        oth_xml.add_pkg(pkg)
-                        pri_db.add_pkg(pkg)
-                        fil_db.add_pkg(pkg)
-                        oth_db.add_pkg(pkg)
+                        cache.put(path, st, records.package_to_record(pkgs[idx]))
         else:
-            for idx, filename in enumerate(pkg_list):
-                process_pkg(filename[0], filename[1])
+            for idx, path, st, href in to_parse:
+                try:
+                    pkgs[idx] = process_pkg(path, href)
+                except Exception as exc:
+                    logging.exception("Unable to process package {}".format(path))
+                else:
+                    cache.put(path, st, records.package_to_record(pkgs[idx]))
                 collect_result(None)
 
+        cache.prune()
+        cache.close()
+        if ledger is not None:
+            ledger.close()
+
+        self.build_manifest(pkgs, staging)
+
+        for pkg in pkgs:
+            if pkg is None:
+                continue
+            pri_xml.add_pkg(pkg)
+            fil_xml.add_pkg(pkg)
+            oth_xml.add_pkg(pkg)
+            pri_db.add_pkg(pkg)
+            fil_db.add_pkg(pkg)
+            oth_db.add_pkg(pkg)
+
         pri_xml.close()
         fil_xml.close()
         oth_xml.close()
@@ -704,6 +1312,14 @@ class YumRepo(object):
                 f.write('packages/{}\n'.format(pkg))
 
 
+    def build_manifest(self, pkgs, directory):
+        """ Write the manifest of the packages into directory, see yumsync.manifest. """
+        manifest.write(os.path.join(directory, manifest.MANIFEST), (
+            manifest.Entry(pkg.location_href,
+                           manifest.nevra_string(pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch),
+                           pkg.size_package, pkg.checksum_type, pkg.pkgId)
+            for pkg in pkgs if pkg is not None))
+
     def prepare_metadata(self):
         self.get_md_data()
         self._callback('repo_metadata', 'building')
@@ -727,6 +1343,11 @@ class YumRepo(object):
                 shutil.rmtree(repodata_dir)
             shutil.copytree(os.path.join(staging, 'repodata'), repodata_dir)
 
+        # the manifest is only replaced along with the repodata it describes
+        manifest_tmp = os.path.join(self.log_dir, '.{}.tmp'.format(manifest.MANIFEST))
+        shutil.copyfile(os.path.join(staging, manifest.MANIFEST), manifest_tmp)
+        os.rename(manifest_tmp, os.path.join(self.log_dir, manifest.MANIFEST))
+
         # cleanup temporary metadata
         shutil.rmtree(staging)
 
@@ -751,21 +1372,93 @@ class YumRepo(object):
             if os.path.lexists(os.path.join(self.dir, 'stable')):
                 os.unlink(os.path.join(self.dir, 'stable'))
 
-    def sync(self, workers=1):
-        self.setup()
+    def sync(self, workers=1, metadata_backend='thread'):
+        with self.hold_lock():
+            plan = self.plan_sync(workers, metadata_backend)
+            if plan is None:
+                return
+            try:
+                failed = self._downloader().download(plan['targets'], callback=self._download_done)
+            except (KeyboardInterrupt, SystemExit):
+                # never save an incomplete package set as the last sync state
+                self._download_failed = True
+                return
+            except Exception as e:
+                self._callback('repo_error', 'PackageDownloadError: {}'.format(e))
+                return False
+            return self.finish_sync(plan, failed)
+
+    def plan_sync(self, workers=1, metadata_backend='thread'):
+        """ First half of sync(), up to the packages left to download.
+
+        Returns a picklable plan to pass to finish_sync() once the targets it
+        lists have been downloaded, or None if there is nothing left to do.
+        This lets yumsync.sync() download the packages of every repository
+        through one scheduler instead of each pool process on its own.
+        """
         self._workers = workers
-        try:
-            self.setup_directories()
-            self.download_gpgkey()
-            self.prepare_packages()
-            self.prepare_metadata()
-            self.create_links()
-        except MetadataBuildError:
-            self._callback('repo_error', 'MetadataBuildError')
-            return False
-        except PackageDownloadError:
-            self._callback('repo_error', 'PackageDownloadError')
-            return False
+        self._metadata_backend = metadata_backend
+        with self._repo_lock():
+            self.setup()
+            try:
+                # checked before setup_directories(), which empties snapshot
+                # directories an unchanged sync would not fill again
+                if self._is_unchanged():
+                    self._callback('repo_unchanged')
+                    self.create_links()
+                    return None
+                self.setup_directories()
+                self.download_gpgkey()
+                if self.local_dir:
+                    targets, upstream, upstream_repomd = [], None, None
+                else:
+                    targets = self._plan_remote_packages()
+                    # everything finish_sync() needs from upstream, so it never loads
+                    # metadata upstream may have published since
+                    upstream = self._upstream_state()
+                    upstream_repomd = self._read_upstream_repomd()
+            except PackageDownloadError:
+                self._callback('repo_error', 'PackageDownloadError')
+                return None
+        return {
+            'workers': workers,
+            'metadata_backend': metadata_backend,
+            'packages': self._packages,
+            'targets': targets,
+            'upstream_md_dir': self._upstream_md_dir,
+            'upstream': upstream,
+            'upstream_repomd': upstream_repomd,
+        }
+
+    def finish_sync(self, plan, failed):
+        """ Second half of sync(), once the targets of plan were downloaded. """
+        self._workers = plan['workers']
+        self._metadata_backend = plan['metadata_backend']
+        with self._repo_lock():
+            if self.local_dir and getattr(self, '_base', None) is None:
+                # planned by another process
+                self.setup()
+            try:
+                with self._open_header_index():
+                    if self.local_dir:
+                        self._download_local_packages()
+                    else:
+                        self._packages = plan['packages']
+                        self._upstream_md_dir = plan['upstream_md_dir']
+                        self._upstream = plan['upstream']
+                        self._upstream_repomd = plan['upstream_repomd']
+                        self._downloads_complete(plan['targets'], failed)
+                    self.prune_packages()
+                self.version_packages()
+                self.prepare_metadata()
+                self._save_sync_state()
+                self.create_links()
+            except MetadataBuildError:
+                self._callback('repo_error', 'MetadataBuildError')
+                return False
+            except PackageDownloadError:
+                self._callback('repo_error', 'PackageDownloadError')
+                return False
 
     def __str__(self):
         raw_info = {}
@@ -789,6 +1482,18 @@ class YumRepo(object):
             raw_info['srcpkgs'] = self.srcpkgs
         if self.newestonly is not None:
             raw_info['newestonly'] = self.newestonly
+        if self.keep_versions is not None:
+            raw_info['keep_versions'] = self.keep_versions
+        if self.keep_snapshots is not None:
+            raw_info['keep_snapshots'] = self.keep_snapshots
+        if self.keep_snapshots_newer is not None:
+            raw_info['keep_snapshots_newer'] = self.keep_snapshots_newer
+        if self.upstream_metadata is not None:
+            raw_info['upstream_metadata'] = self.upstream_metadata
+        if self.cachedir:
+            raw_info['cachedir'] = self.cachedir
+        if self.metadata_expire is not None:
+            raw_info['metadata_expire'] = self.metadata_expire
         if self.labels is not []:
             raw_info['labels'] = str(self.labels)
         friendly_info = ['{}({})'.format(k, raw_info[k]) for k in sorted(raw_info)]